@@ -0,0 +1,135 @@
+from collections import namedtuple
+
+import numpy as np
+
+BootstrapResult = namedtuple('BootstrapResult',
+                            ['mean', 'std', 'ci_low', 'ci_high', 'distribution'])
+
+def bootstrap(data, n_bs=100000, log=False, ci=95, seed=None, n_workers=1,
+            max_elements=2**22, return_distribution=False):
+    """ Bootstrap the NaN-aware mean of a set of samples
+
+    Parameters
+    ---------
+    data : array-like, shape=(n_samples,) or (n_samples, n_windows)
+        One row per sample, e.g. a permeability per sweep or a profile
+        per sweep. NaN entries are left out of each resample's mean
+    n_bs : int, default=100000
+        Number of bootstrap resamples
+    log : bool, default=False
+        If True, resample log(data), then report the bootstrap means
+        back in linear space (a geometric mean)
+    ci : float or None, default=95
+        Width of the percentile confidence interval, in percent.
+        If None (and not return_distribution), only running sums are kept
+        so memory does not depend on n_bs
+    seed : int, optional
+        Resamples are drawn in chunks, each seeded from a child of one
+        SeedSequence, so results depend on seed and max_elements
+        but not on n_workers
+    n_workers : int, default=1
+        Number of processes drawing chunks of resamples
+    max_elements : int, default=2**22
+        Bound on n_chunk * n_samples * n_windows, the size of one chunk of
+        resampled data
+    return_distribution : bool, default=False
+        Keep the (n_bs, ...) bootstrap means in the result
+
+    Returns
+    -------
+    result : BootstrapResult
+        mean : mean of the bootstrap means (exp of the mean of logs if log)
+        std : standard deviation of the bootstrap means, in linear space
+        ci_low, ci_high : percentile interval, None if ci is None
+        distribution : bootstrap means in linear space, or None
+    """
+    data = np.asarray(data, dtype=float)
+    if log:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data = np.log(data)
+    n_samples = data.shape[0]
+    n_per_sample = int(np.prod(data.shape[1:]))
+    chunk_size = max(1, max_elements // max(1, n_samples * n_per_sample))
+    chunk_sizes = [min(chunk_size, n_bs - start) for start in range(0, n_bs, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    jobs = [(data, child, size, log) for child, size in zip(seeds, chunk_sizes)]
+
+    keep = ci is not None or return_distribution
+    if n_workers == 1:
+        chunks = map(_bootstrap_chunk, jobs)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        chunks = executor.map(_bootstrap_chunk, jobs)
+
+    # Chan et al. merge of per-chunk moments, NaN-aware
+    moments = None
+    distribution = []
+    try:
+        for log_means, means in chunks:
+            stats = _moments(log_means if log else means), _moments(means)
+            moments = stats if moments is None else tuple(
+                        _merge_moments(a, b) for a, b in zip(moments, stats))
+            if keep:
+                distribution.append(means)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    (_, center, _), (count, _, m2) = moments
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(m2 / count)
+    mean = np.exp(center) if log else center
+
+    ci_low = ci_high = None
+    if keep:
+        distribution = np.concatenate(distribution)
+    if ci is not None:
+        ci_low, ci_high = np.nanpercentile(distribution, [50 - ci/2, 50 + ci/2],
+                                            axis=0)
+    return BootstrapResult(mean, std, ci_low, ci_high,
+                        distribution if return_distribution else None)
+
+def _bootstrap_chunk(job):
+    """ Means of one chunk of resamples
+
+    Returns
+    -------
+    means : the resample means of data (in log space if log)
+    linear_means : the same, in linear space
+    """
+    data, seed, size, log = job
+    rng = np.random.default_rng(seed)
+    n_samples = data.shape[0]
+    indices = rng.integers(0, n_samples, size=(size, n_samples))
+
+    valid = ~np.isnan(data)
+    sums = np.sum(np.where(valid, data, 0.0)[indices], axis=1)
+    counts = np.sum(valid[indices], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    linear_means = np.exp(means) if log else means
+    return means, linear_means
+
+def _moments(values):
+    """ NaN-aware count, mean, and sum of squared deviations along axis 0 """
+    valid = ~np.isnan(values)
+    count = np.sum(valid, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.sum(np.where(valid, values, 0.0), axis=0) / count
+        m2 = np.sum(np.where(valid, values - mean, 0.0)**2, axis=0)
+    return count, mean, m2
+
+def _merge_moments(a, b):
+    """ Combine moments of two chunks """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = mean_b - mean_a
+        mean = np.where(count_a == 0, mean_b, np.where(count_b == 0, mean_a,
+                        mean_a + delta * count_b / count))
+        m2 = np.where(count_a == 0, m2_b, np.where(count_b == 0, m2_a,
+                        m2_a + m2_b + delta**2 * count_a * count_b / count))
+    return count, mean, m2
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+
+import permeability_functions.io_functions as io_functions
+
+# Content-addressed cache of per-window analysis results
+# An entry's key hashes the forceout file's contents together with every
+# analysis parameter, so a changed input or parameter can never hit an
+# old entry; outdated entries simply stop being used and age out
+
+# Bump when the estimator or the stored fields change
+CACHE_VERSION = 3
+
+class ResultCache(object):
+    """ On-disk cache of mean forces, FACFs, FACF integrals, and mean force errors
+
+    Parameters
+    ---------
+    directory : str
+        Where entries are stored, created if needed
+    max_bytes : int, default=2**30
+        Size budget enforced by `evict`
+
+    Notes
+    -----
+    Entries are written atomically, so concurrent workers can share a
+    cache. A hit refreshes the entry's mtime, and `evict` removes the 
+    least recently used entries first. Unreadable entries are deleted
+    and treated as misses
+    """
+    fields = ('mean_force', 'facf', 'facf_integral', 'mean_force_sem', 'dstep')
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, filename, **params):
+        """ Key from the contents of filename and the analysis parameters """
+        params = dict(params, version=CACHE_VERSION)
+        digest = hashlib.sha1(io_functions.source_sha1(filename).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, key):
+        """ Cached results as a dict, or None on a miss """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                result = {field: entry[field] for field in self.fields}
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, mean_force, facf, facf_integral, mean_force_sem, dstep):
+        """ Store results under key """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), 
+                                        suffix='.tmp', delete=False) as f:
+            np.savez(f, mean_force=mean_force, facf=facf,
+                    facf_integral=facf_integral, mean_force_sem=mean_force_sem,
+                    dstep=dstep)
+        os.replace(f.name, path)
+
+    def evict(self):
+        """ Delete least recently used entries until within max_bytes """
+        entries = []
+        for subdir, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(subdir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith('.tmp'):
+                    # Leftover from an interrupted put, unless still being written
+                    if time.time() - stat.st_mtime > 3600:
+                        self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
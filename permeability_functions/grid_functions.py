@@ -1,120 +1,507 @@
+import itertools
+
 import numpy as np
-import mdtraj
-import grid_analysis
-import bilayer_analysis_functions
 import simtk.unit as u
 
-def distance_from_interface(traj, tracer_resid):
+import permeability_functions.spatial_functions as spatial_functions
+
+# grid_analysis and bilayer_analysis_functions are optional extras,
+# imported inside the functions that use them, so importing this module
+# (or anything else in the package) does not fail when they are not 
+# installed. Trajectories come from mdtraj, but nothing here calls into it
+
+def distance_from_interface(traj, tracer_resid, time_resolved=False,
+                            n_neighbors=None, grid_size=1.0, 
+                            topology_metadata=None):
     """ Given a trajectory and a tracer residue, find the closest interface
 
-    traj : mdtraj.Trajectory
+    traj : mdtraj.Trajectory or iterable of mdtraj.Trajectory
+        A whole trajectory, or chunks of one, e.g. from mdtraj.iterload.
+        Chunks are only read once
     tracer_resid : int or iterable
+    time_resolved : bool, default=False
+        If True, compare each frame's tracer position against that frame's
+        interfaces instead of using time averages
+    n_neighbors : int, optional
+        If given, the local interface of each leaflet is the mass-weighted
+        height of the n_neighbors headgroups nearest to the tracer (in xy,
+        with periodic boundaries) instead of the tracer's grid cell
+    grid_size : float, default=1.0
+        Approximate width (nm) of the local interface cells
+    topology_metadata : topology_functions.TopologyMetadata, optional
+        Cached headgroup indices, masses, and tracer atoms of this system.
+        By default, these are looked up from traj's topology
+
+    Returns
+    -------
+    times : np.ndarray, shape=(n_frames,)
+        Frame times in ps, only if time_resolved
+    d_from_local_i : np.ndarray, shape=(n_tracers,)
+        Distance of each tracer from the closer local interface, in nm, 
+        positive on the water side. A float if tracer_resid is an int.
+        shape=(n_frames, n_tracers) (or (n_frames,)) if time_resolved
+    d_from_leaflet_i : np.ndarray, shape=(n_tracers,)
+        Distance from the matching leaflet's mean interface
 
     Note
     -----
-    Comparisons are based on time-averaged interfaces and coordinates
+    By default, comparisons are based on time-averaged interfaces and 
+    coordinates. These are accumulated as running sums over chunks, so 
+    memory does not depend on trajectory length. Leaflets and the number 
+    of grid cells are taken from the first chunk.
+    Cells divide each frame's box (fractional coordinates, wrapped into 
+    the box), so they follow box fluctuations and atoms are never binned
+    past the grid edges.
+    With time_resolved, only the interface heights of the cells the tracers
+    occupy are kept from each frame. A cell without headgroups in some frame
+    falls back to its time-averaged height.
+    With n_neighbors, a spatial_functions.HeadgroupIndex is built for each
+    chunk, and the local interface is found for the tracer's position in 
+    each frame. Time-averaged distances then compare the mean tracer height
+    against the mean of these per-frame local interfaces
     """
     
-    water_indices = traj.topology.select('water') 
-    headgroup_indices = grid_analysis._get_headgroup_indices(traj)
-
-    # Get leaflet interfaces
-    bot_interface, top_interface  = find_interface_lipid(traj, headgroup_indices)
-    leaflet_interfaces = [np.mean(bot_interface), np.mean(top_interface)]
-
-
-    # Find local interface within each grid
-    _, xbin_centers, ybin_centers, xedges, yedges = grid_surface(traj, grid_size=1.0)
-    xbin_width = xbin_centers[1] - xbin_centers[0]
-    ybin_width = ybin_centers[1] - ybin_centers[0]
-
-    top_interface_grid = np.zeros((len(xbin_centers), len(ybin_centers)))
-    bot_interface_grid = np.zeros((len(xbin_centers), len(ybin_centers)))
-    for i, x in enumerate(xbin_centers):
-        for j, y in enumerate(ybin_centers):
-            atoms_xy = grid_analysis._find_atoms_within(traj, x=x, y=y, 
-                    atom_indices=headgroup_indices,
-                    xbin_width=xbin_width, ybin_width=ybin_width)
-            z_interface_bot, z_interface_top = find_interface_lipid(traj, atoms_xy)
-            (bot_interface_avg, top_interface_avg) = (np.mean(z_interface_bot), 
-                                                    np.mean(z_interface_top))
-            bot_interface_grid[i,j] = bot_interface_avg
-            top_interface_grid[i,j] = top_interface_avg
-
-    # if tracer_resid is iterable
-    try: 
-        d_from_local_i_list = []
-        d_from_leaflet_i_list = []
-        for tracer in tracer_resid:
-            res = traj.topology.residue(tracer)
-            tracer_oxygen = res.atom(0)
-            xyz = np.mean(traj.xyz[:, tracer_oxygen.index, :], axis=0)
-            bin_x = np.digitize(xyz[0], xedges) - 1
-            bin_y = np.digitize(xyz[1], yedges) - 1
-
-            # Identify the z interface for this xy region
-            (interface_bot, interface_top) = (bot_interface_grid[bin_x, bin_y],
-                                                top_interface_grid[bin_x, bin_y])
-
-            # Find distance from local interface and leaflet interface
-            # Pick the closer interface
-            if abs(interface_bot - xyz[2]) < abs(interface_top - xyz[2]):
-                d_from_local_i = interface_bot - xyz[2]
-                d_from_leaflet_i = leaflet_interfaces[0] - xyz[2]
-                closest_interface = interface_bot
-            else:
-                d_from_local_i = xyz[2] - interface_top
-                d_from_leaflet_i = xyz[2] - leaflet_interfaces[1] 
-                closest_interface = interface_top
-            d_from_local_i_list.append(d_from_local_i)
-            d_from_leaflet_i_list.append(d_from_leaflet_i)
+    chunks = _iter_chunks(traj)
+    first = next(chunks)
+    if topology_metadata is None:
+        import grid_analysis
+        headgroup_indices = grid_analysis._get_headgroup_indices(first)
+        masses = _atom_masses(first.topology)
+        tracer_indices = _tracer_atom_indices(first.topology, tracer_resid)
+    else:
+        headgroup_indices = topology_metadata.headgroup_indices()
+        masses = topology_metadata.masses()
+        tracer_indices = topology_metadata.residue_atoms()[
+                                            np.atleast_1d(tracer_resid)]
+    leaflets = _sort_leaflets(first, headgroup_indices)
+    grid_shape = _grid_shape(first, grid_size)
+
+    n_frames = 0
+    box_sums = np.zeros(3)
+    leaflet_sums = np.zeros(2)
+    grid_sums = np.zeros((2,) + grid_shape)
+    grid_counts = np.zeros_like(grid_sums)
+    tracer_sums = np.zeros((len(tracer_indices), 3))
+    frame_values = []
+    if n_neighbors:
+        neighbor_sums = np.zeros((2, len(tracer_indices)))
+    for chunk in itertools.chain([first], chunks):
+        n_frames += chunk.n_frames
+        box_sums += np.sum(chunk.unitcell_lengths, axis=0, dtype=np.float64)
+        # Get leaflet interfaces
+        leaflet_z = np.column_stack(find_interface_lipid(chunk, 
+                                    headgroup_indices, leaflets=leaflets,
+                                    masses=masses))
+        leaflet_sums += np.sum(leaflet_z, axis=0)
+        # Find local interface within each grid
+        heights = np.stack(interface_grids(chunk, headgroup_indices, 
+                                    grid_shape, leaflets=leaflets, 
+                                    masses=masses))
+        valid = ~np.isnan(heights)
+        grid_sums += np.sum(np.where(valid, heights, 0.0), axis=1)
+        grid_counts += np.sum(valid, axis=1)
+        tracer_frames = chunk.xyz[:, tracer_indices, :]
+        tracer_sums += np.sum(tracer_frames, axis=0, dtype=np.float64)
+
+        if n_neighbors:
+            index = spatial_functions.HeadgroupIndex(chunk, headgroup_indices,
+                                                    leaflets=leaflets)
+            neighbor_heights = index.interface_heights(chunk.xyz, masses,
+                                            tracer_frames[:, :, :2], k=n_neighbors)
+            neighbor_sums += np.sum(neighbor_heights, axis=1)
+            if time_resolved:
+                frame_values.append((chunk.time, tracer_frames[:, :, 2], 
+                                    leaflet_z, neighbor_heights))
+        elif time_resolved:
+            bins_x, bins_y = _fractional_bins(tracer_frames, 
+                                            chunk.unitcell_lengths, grid_shape)
+            frames = np.arange(chunk.n_frames)[:, np.newaxis]
+            frame_values.append((chunk.time, tracer_frames[:, :, 2], leaflet_z,
+                                bins_x, bins_y, heights[:, frames, bins_x, bins_y]))
+
+    leaflet_interfaces = leaflet_sums / n_frames
+    # Cells that never hold a headgroup stay NaN
+    with np.errstate(invalid='ignore'):
+        interface_grid = grid_sums / grid_counts
 
-        return d_from_local_i_list, d_from_leaflet_i_list
+    if time_resolved:
+        columns = list(zip(*frame_values))
+        times, z, leaflet_z = map(np.concatenate, columns[:3])
+        local_heights = np.concatenate(columns[-1], axis=1)
+        if not n_neighbors:
+            bins_x, bins_y = map(np.concatenate, columns[3:5])
+            local_heights = np.where(np.isnan(local_heights),
+                                interface_grid[:, bins_x, bins_y], local_heights)
+        d_from_local_i, d_from_leaflet_i = _closest_interface_distances(z,
+                                local_heights, leaflet_z.T[:, :, np.newaxis])
+        # if tracer_resid is a single resid
+        if np.ndim(tracer_resid) == 0:
+            return times, d_from_local_i[:, 0], d_from_leaflet_i[:, 0]
+        return times, d_from_local_i, d_from_leaflet_i
+
+    # Identify the z interface for each tracer's xy region
+    tracer_xyz = tracer_sums / n_frames
+    if n_neighbors:
+        local_interfaces = neighbor_sums / n_frames
+    else:
+        bins_x, bins_y = _fractional_bins(tracer_xyz[np.newaxis], 
+                                    box_sums[np.newaxis] / n_frames, grid_shape)
+        local_interfaces = interface_grid[:, bins_x[0], bins_y[0]]
+    d_from_local_i, d_from_leaflet_i = _closest_interface_distances(
+                            tracer_xyz[:, 2], local_interfaces,
+                            leaflet_interfaces[:, np.newaxis])
 
     # if tracer_resid is a single resid
-    except IndexError:
-        res = traj.topology.residue(tracer_resid)
-        tracer_oxygen = res.atom(0)
-        # Identify which xy region we're in 
-        xyz = np.mean(traj.xyz[:, tracer_oxygen.index, :], axis=0)
-        bin_x = np.digitize(xyz[0], xedges) - 1
-        bin_y = np.digitize(xyz[1], yedges) - 1
-
-        # Identify the z interface for this xy region
-        (interface_bot, interface_top) = (bot_interface_grid[bin_x, bin_y],
-                                            top_interface_grid[bin_x, bin_y])
-
-        # Find distance from local interface and leaflet interface
-        # Pick the closer interface
-        if abs(interface_bot - xyz[2]) < abs(interface_top - xyz[2]):
-            d_from_local_i = interface_bot - xyz[2]
-            d_from_leaflet_i = leaflet_interfaces[0] - xyz[2]
-            closest_interface = interface_bot
-        else:
-            d_from_local_i = xyz[2] - interface_top
-            d_from_leaflet_i = xyz[2] - leaflet_interfaces[1] 
-            closest_interface = interface_top
-
-        return d_from_local_i, d_from_leaflet_i
+    if np.ndim(tracer_resid) == 0:
+        return d_from_local_i[0], d_from_leaflet_i[0]
+    return d_from_local_i, d_from_leaflet_i
+
+def _closest_interface_distances(z, local_interfaces, leaflet_interfaces):
+    """ Distances from the closer local interface and the matching leaflet
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Tracer heights
+    local_interfaces : np.ndarray, shape=(2,) + z.shape
+        Bottom and top local interface heights at each tracer
+    leaflet_interfaces : np.ndarray
+        Bottom and top leaflet interfaces along the first axis,
+        broadcastable against local_interfaces
+    """
+    # Find distance from local interface and leaflet interface
+    # Pick the closer interface
+    interface_bot, interface_top = local_interfaces
+    closer_to_bot = np.abs(interface_bot - z) < np.abs(interface_top - z)
+    d_from_local_i = np.where(closer_to_bot, interface_bot - z, z - interface_top)
+    d_from_leaflet_i = np.where(closer_to_bot, leaflet_interfaces[0] - z, 
+                                z - leaflet_interfaces[1])
+    return d_from_local_i, d_from_leaflet_i
+
+def coordinates_at_times(times, frame_times, coordinates):
+    """ Instantaneous reaction coordinate at arbitrary times
+
+    Parameters
+    ----------
+    times : np.ndarray, shape=(n_samples,)
+        e.g. force sample times, in the same unit as frame_times
+    frame_times : np.ndarray, shape=(n_frames,)
+        Sorted frame times, as returned with time_resolved
+        distance_from_interface
+    coordinates : np.ndarray, shape=(n_frames,)
+        One tracer's time-resolved coordinate
+
+    Returns
+    -------
+    sample_coordinates : np.ndarray, shape=(n_samples,)
+        Coordinate of the latest frame at or before each time
+    """
+    frames = np.searchsorted(frame_times, times, side='right') - 1
+    return coordinates[np.clip(frames, 0, len(frame_times) - 1)]
+
+def bin_forces_by_coordinate(forces, sample_coordinates, bin_edges):
+    """ Mean force in bins of the instantaneous reaction coordinate
+
+    Parameters
+    ----------
+    forces : np.ndarray, shape=(n_samples,)
+    sample_coordinates : np.ndarray, shape=(n_samples,)
+        e.g. from coordinates_at_times
+    bin_edges : np.ndarray, shape=(n_bins + 1,)
+
+    Returns
+    -------
+    mean_forces : np.ndarray, shape=(n_bins,)
+        NaN for bins without samples
+    counts : np.ndarray, shape=(n_bins,)
+        Number of samples in each bin, the weight of each bin's mean force
+    """
+    n_bins = len(bin_edges) - 1
+    bins = np.searchsorted(bin_edges, sample_coordinates, side='right') - 1
+    inside = (bins >= 0) & (bins < n_bins) & ~np.isnan(sample_coordinates)
+    counts = np.bincount(bins[inside], minlength=n_bins)
+    force_sums = np.bincount(bins[inside], weights=forces[inside], 
+                            minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_forces = force_sums / counts
+    return mean_forces, counts
+
+def _tracer_atom_indices(topology, tracer_resid):
+    """ Index of the first atom (the oxygen) of each tracer residue """
+    return np.array([topology.residue(tracer).atom(0).index 
+                    for tracer in np.atleast_1d(tracer_resid)], dtype=int)
+
+def _iter_chunks(traj):
+    """ Iterate over a trajectory given whole, or as chunks """
+    if hasattr(traj, 'xyz'):
+        return iter([traj])
+    return iter(traj)
     
-def find_interface_lipid(traj, headgroup_indices):
-    """ Find the interface based on lipid head groups"""
+def interface_grids(traj, headgroup_indices, grid_shape, leaflets=None,
+                    masses=None):
+    """ Per-frame local interface heights of both leaflets on an xy grid
+
+    Parameters
+    ----------
+    traj : mdtraj.Trajectory
+    headgroup_indices : array-like of int
+    grid_shape : tuple of (n_xbins, n_ybins)
+        Number of cells along x and y, each frame's box is divided evenly
+    leaflets : tuple of (bot_leaflet, top_leaflet) atom indices, optional
+        By default, sorted from the first frame as in find_interface_lipid
+    masses : np.ndarray, shape=(n_atoms,), optional
+        Atomic masses, by default read from the topology
+
+    Returns
+    -------
+    bot_heights, top_heights : np.ndarray, shape=(n_frames, n_xbins, n_ybins)
+        Mass-weighted mean z of each leaflet's headgroup atoms within
+        each xy cell, per frame. NaN where a cell holds no headgroups
+
+    Notes
+    -----
+    Atoms are binned by their fractional xy position (wrapped into the box)
+    in every frame, and all cells and frames are reduced in one weighted 
+    bincount per leaflet
+    """
+    if leaflets is None:
+        leaflets = _sort_leaflets(traj, headgroup_indices)
+    bot_leaflet, top_leaflet = leaflets
+    if masses is None:
+        masses = _atom_masses(traj.topology)
+    return tuple(_cell_mean_heights(traj.xyz[:, leaflet, :], 
+                                    traj.unitcell_lengths, masses[leaflet], 
+                                    grid_shape)
+                for leaflet in (bot_leaflet, top_leaflet))
+
+def _cell_mean_heights(xyz, box_lengths, masses, grid_shape):
+    """ Mass-weighted mean z per (frame, xbin, ybin) """
+    n_frames, n_atoms = xyz.shape[:2]
+    n_xbins, n_ybins = grid_shape
+    xbins, ybins = _fractional_bins(xyz, box_lengths, grid_shape)
+    frames = np.arange(n_frames)[:, np.newaxis]
+    cells = ((frames * n_xbins + xbins) * n_ybins + ybins).ravel()
+
+    n_cells = n_frames * n_xbins * n_ybins
+    weights = np.broadcast_to(masses, (n_frames, n_atoms))
+    mass_sums = np.bincount(cells, weights=weights.ravel(), minlength=n_cells)
+    z_sums = np.bincount(cells, weights=(weights * xyz[:, :, 2]).ravel(),
+                        minlength=n_cells)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        heights = z_sums / mass_sums
+    return heights.reshape(n_frames, n_xbins, n_ybins)
+
+def _fractional_bins(xyz, box_lengths, grid_shape):
+    """ Periodic xy cells of each atom, from box-scaled coordinates
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n_frames, n_atoms, >=2)
+    box_lengths : np.ndarray, shape=(n_frames, >=2)
+    grid_shape : tuple of (n_xbins, n_ybins)
 
+    Returns
+    -------
+    xbins, ybins : np.ndarray of int, shape=(n_frames, n_atoms)
+    """
+    bins = []
+    for dim, n_bins in enumerate(grid_shape):
+        fractional = xyz[:, :, dim] / box_lengths[:, dim, np.newaxis]
+        fractional = fractional - np.floor(fractional)
+        bins.append(np.minimum((fractional * n_bins).astype(int), n_bins - 1))
+    return bins
+
+def _grid_shape(traj, grid_size):
+    """ Number of xy cells of about grid_size in the mean box of traj """
+    box = np.mean(traj.unitcell_lengths[:, :2], axis=0)
+    return tuple(max(1, int(round(length / grid_size))) for length in box)
+
+def find_interface_lipid(traj, headgroup_indices, leaflets=None, masses=None):
+    """ Find the interface based on lipid head groups
+
+    Parameters
+    ----------
+    traj : mdtraj.Trajectory or iterable of mdtraj.Trajectory
+        A whole trajectory, or chunks of one, e.g. from mdtraj.iterload
+    headgroup_indices : array-like of int
+    leaflets : tuple of (bot_leaflet, top_leaflet) atom indices, optional
+        By default, sorted from the first frame
+    masses : np.ndarray, shape=(n_atoms,), optional
+        Atomic masses, by default read from the topology
+
+    Returns
+    -------
+    com_bot, com_top : np.ndarray, shape=(n_frames,)
+        z of each leaflet's center of mass
+    """
+    chunks = _iter_chunks(traj)
+    first = next(chunks)
+    if leaflets is None:
+        leaflets = _sort_leaflets(first, headgroup_indices)
+    if masses is None:
+        masses = _atom_masses(first.topology)
+
+    coms = [_centers_of_mass(chunk.xyz[:, :, 2:], leaflets, masses)[:, :, 0]
+            for chunk in itertools.chain([first], chunks)]
+    com_bot, com_top = np.concatenate(coms).T
+    return com_bot, com_top
+
+def _atom_masses(topology):
+    """ Mass of every atom in the topology, in amu """
+    return np.array([atom.element.mass for atom in topology.atoms])
+
+def _centers_of_mass(xyz, groups, masses):
+    """ Per-frame centers of mass of many groups of atoms at once
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n_frames, n_atoms, n_dims)
+    groups : sequence of np.ndarray of int
+        Atom indices of each group
+    masses : np.ndarray, shape=(n_atoms,)
+
+    Returns
+    -------
+    coms : np.ndarray, shape=(n_frames, n_groups, n_dims)
+        NaN for empty groups
+
+    Notes
+    -----
+    The groups' atoms are concatenated and summed per group with one 
+    segment reduction (np.add.reduceat), without copying the topology
+    """
+    lengths = np.array([len(group) for group in groups])
+    coms = np.full((xyz.shape[0], len(groups), xyz.shape[2]), np.nan)
+    nonempty = np.flatnonzero(lengths)
+    if nonempty.shape[0] == 0:
+        return coms
+    atoms = np.concatenate([np.asarray(groups[i], dtype=int) for i in nonempty])
+    offsets = np.concatenate(([0], np.cumsum(lengths[nonempty])[:-1]))
+    weights = masses[atoms]
+    weighted_sums = np.add.reduceat(xyz[:, atoms, :] * weights[:, np.newaxis],
+                                    offsets, axis=1)
+    coms[:, nonempty, :] = (weighted_sums / 
+                            np.add.reduceat(weights, offsets)[:, np.newaxis])
+    return coms
+
+def _sort_leaflets(traj, headgroup_indices):
+    """ Split headgroup atoms into bottom and top leaflets by their first-frame
+    z, dropping atoms within 1 nm of that frame's midplane """
     # Sort into top and bottom leaflet
     #midplane = np.mean(traj.xyz[:,headgroup_indices,2])
-    midplane = np.mean(traj.unitcell_lengths[:,2])/2
-    bot_leaflet = [a for a in headgroup_indices if traj.xyz[0,a,2] < midplane and abs(traj.xyz[0,a,2] - midplane) > 1]
-    top_leaflet = [a for a in headgroup_indices if traj.xyz[0,a,2] > midplane and abs(traj.xyz[0,a,2] - midplane) > 1]
+    midplane = traj.unitcell_lengths[0,2]/2
+    headgroup_indices = np.asarray(headgroup_indices, dtype=int)
+    labels = spatial_functions.sort_leaflets(traj.xyz[0, headgroup_indices, 2],
+                                            midplane)
+    return headgroup_indices[labels == -1], headgroup_indices[labels == 1]
+
+def grid_surface(traj, grid_size=0.2, dtype=np.float64, average=False, 
+                block_size=1000, fractional=False, masses=None):
+    """ Compute a density heatmap by gridding up space 
 
-    com_bot = mdtraj.compute_center_of_mass(traj.atom_slice(bot_leaflet))
-    com_top = mdtraj.compute_center_of_mass(traj.atom_slice(top_leaflet))
+    Parameters
+    ----------
+    traj : mdtraj.Trajectory or iterable of mdtraj.Trajectory
+        A whole trajectory, or chunks of one, e.g. from mdtraj.iterload.
+        With chunks, the grid is laid out from the first chunk
+    grid_size : float, default=0.2
+        Approximate xy bin width in nm
+    dtype : np.dtype, default=np.float64
+        dtype of the returned density, e.g. np.float32 to halve memory
+    average : bool, default=False
+        If True, only accumulate the time-averaged density, so memory
+        does not scale with the number of frames
+    block_size : int, default=1000
+        Number of frames binned at once
+    fractional : bool, default=False
+        If True, bins divide each frame's box and atoms are wrapped into it,
+        so bins follow box fluctuations. Edges are reported for the 
+        mean box of the first chunk, starting at 0.
+        Otherwise, bins span the atoms' min/max over the first chunk
+    masses : np.ndarray, shape=(n_atoms,), optional
+        Atomic masses in amu, e.g. from topology_functions.TopologyMetadata.
+        By default, from bilayer_analysis_functions.get_all_masses
 
-    return com_bot[:,2], com_top[:,2]
+    Returns
+    -------
+    density : np.ndarray, shape=(n_frames, n_xbins, n_ybins)
+        Mass density per frame, shape=(n_xbins, n_ybins) if average
+    xbin_centers, ybin_centers, xedges, yedges : np.ndarray
+    """
+    chunks = _iter_chunks(traj)
+    first = next(chunks)
+
+    xedges, yedges, thickness = _grid_edges(first, grid_size, fractional=fractional)
+    n_xbins = len(xedges) - 1
+    xbin_width = (xedges[-1] - xedges[0]) / n_xbins
+    n_ybins = len(yedges) - 1
+    ybin_width = (yedges[-1] - yedges[0]) / n_ybins
+
+    v_slice = xbin_width * ybin_width * thickness * u.nanometer**3
+
+    if masses is None:
+        import bilayer_analysis_functions
+        atom_indices = [a.index for a in first.topology.atoms]
+        masses = bilayer_analysis_functions.get_all_masses(first, first.topology, atom_indices)
+    else:
+        # Per-atom masses, as from get_all_masses
+        masses = masses * u.dalton / u.AVOGADRO_CONSTANT_NA
+    masses = (masses / v_slice).in_units_of(u.kilogram * (u.meter**-3))._value
+    masses = masses / v_slice._value
+
+    xbin_centers = xedges[1:] - xbin_width / 2
+    ybin_centers = yedges[1:] - ybin_width / 2
+
+    # Bin all frames of a block with one bincount over (frame, xbin, ybin)
+    # A whole trajectory is written into a preallocated array,
+    # chunks of unknown total length are collected and concatenated
+    n_bins = n_xbins * n_ybins
+    if average:
+        density_profile = np.zeros(n_bins)
+    elif hasattr(traj, 'xyz'):
+        density_profile = np.empty((traj.n_frames, n_bins), dtype=dtype)
+    else:
+        density_profile = []
+    n_frames = 0
+    for chunk in itertools.chain([first], chunks):
+        for start in range(0, chunk.n_frames, block_size):
+            xyz = chunk.xyz[start:start + block_size]
+            n_block = xyz.shape[0]
+            if fractional:
+                xbins, ybins = _fractional_bins(xyz, 
+                        chunk.unitcell_lengths[start:start + block_size],
+                        (n_xbins, n_ybins))
+            else:
+                xbins = _bin_indices(xyz[:, :, 0], xedges)
+                ybins = _bin_indices(xyz[:, :, 1], yedges)
+            bins = xbins * n_ybins + ybins
+            weights = np.broadcast_to(masses, bins.shape)
+            if average:
+                density_profile += np.bincount(bins.ravel(), weights=weights.ravel(),
+                                                minlength=n_bins)
+            else:
+                bins += np.arange(n_block)[:, np.newaxis] * n_bins
+                hist = np.bincount(bins.ravel(), weights=weights.ravel(), 
+                                minlength=n_block * n_bins).reshape(n_block, n_bins)
+                if isinstance(density_profile, list):
+                    density_profile.append(hist.astype(dtype))
+                else:
+                    density_profile[n_frames:n_frames + n_block] = hist
+            n_frames += n_block
+
+    if average:
+        density_profile = (density_profile / n_frames).astype(dtype)
+        density_profile = density_profile.reshape(n_xbins, n_ybins)
+    else:
+        if isinstance(density_profile, list):
+            density_profile = np.concatenate(density_profile)
+        density_profile = density_profile.reshape(-1, n_xbins, n_ybins)
 
-def grid_surface(traj, grid_size=0.2):
-    """ Compute a density heatmap by gridding up space """
+    return density_profile, xbin_centers, ybin_centers, xedges, yedges
 
-    atom_indices = [a.index for a in traj.topology.atoms]
+def _grid_edges(traj, grid_size, fractional=False):
+    """ xy bin edges spanning every atom of traj (or its mean box, 
+    if fractional), and its z thickness """
     xbounds = (np.min(traj.xyz[:, :, 0]),
             np.max(traj.xyz[:, :, 0]))
     ybounds = (np.min(traj.xyz[:, :, 1]),
@@ -122,26 +509,20 @@ def grid_surface(traj, grid_size=0.2):
     zbounds = (np.min(traj.xyz[:, :, 2]),
             np.max(traj.xyz[:, :, 2]))
 
-    n_xbins = int(round((xbounds[1] - xbounds[0]) / grid_size))
-    xbin_width = (xbounds[1] - xbounds[0]) / n_xbins
-
-    n_ybins = int(round((ybounds[1] - ybounds[0]) / grid_size))
-    ybin_width = (ybounds[1] - ybounds[0]) / n_ybins
-
-    thickness = zbounds[1] - zbounds[0]
-    density_profile=[]
-    v_slice = xbin_width * ybin_width * thickness * u.nanometer**3
-
-    masses = (bilayer_analysis_functions.get_all_masses(traj, traj.topology, atom_indices) / v_slice).in_units_of(u.kilogram * (u.meter**-3))._value
-
-    for i, frame in enumerate(traj):
-        xyz = traj.xyz[i, :, :]
-        hist, xedges, yedges = np.histogram2d(xyz[:,0], xyz[:,1],
-                bins=[n_xbins, n_ybins], range=[xbounds, ybounds], 
-                normed=False, weights=masses)
-        density_profile.append(hist/v_slice._value)
-        xbin_centers = xedges[1:] - xbin_width / 2
-        ybin_centers = yedges[1:] - ybin_width / 2
-
-    return np.array(density_profile), xbin_centers, ybin_centers, xedges, yedges
+    if fractional:
+        n_xbins, n_ybins = _grid_shape(traj, grid_size)
+        box = np.mean(traj.unitcell_lengths[:, :2], axis=0)
+        xbounds = (0.0, box[0])
+        ybounds = (0.0, box[1])
+    else:
+        n_xbins = int(round((xbounds[1] - xbounds[0]) / grid_size))
+        n_ybins = int(round((ybounds[1] - ybounds[0]) / grid_size))
+    xedges = np.linspace(xbounds[0], xbounds[1], n_xbins + 1)
+    yedges = np.linspace(ybounds[0], ybounds[1], n_ybins + 1)
+    return xedges, yedges, zbounds[1] - zbounds[0]
 
+def _bin_indices(values, edges):
+    """ Bin of each value, like np.histogram, with values on the outer edges
+    (or beyond them) put in the first or last bin """
+    n_bins = len(edges) - 1
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, n_bins - 1)
@@ -0,0 +1,366 @@
+import os
+import json
+import hashlib
+import itertools
+import tempfile
+import warnings
+
+import numpy as np
+
+import permeability_functions.misc as misc
+
+# Binary sidecar cache for forceout text files
+# forceout.dat is converted once to forceout.dat.npy, a column-major
+# (Fortran-ordered) array that np.load can memory-map, next to
+# forceout.dat.npy.json, which records the source file's size, mtime,
+# and sha1 so stale caches are detected and rebuilt
+
+CACHE_SUFFIX = '.npy'
+METADATA_SUFFIX = '.npy.json'
+
+def load_forceout(filename, dtype=np.float64, cache=True, verify_hash=False):
+    """ Load a forceout file, going through the binary cache
+
+    Parameters
+    ---------
+    filename : str
+        Whitespace-delimited text file, '#' lines are skipped
+    dtype : np.dtype, default=np.float64
+    cache : bool, default=True
+        If False, parse the text file without reading or writing the cache
+    verify_hash : bool, default=False
+        If True, check the source sha1 even when size and mtime match
+
+    Returns
+    -------
+    data : np.ndarray, shape=(n_rows, n_cols)
+        Drop-in replacement for np.loadtxt(filename). When cached, this is
+        a read-only memory map, and each column data[:, i] is contiguous
+    """
+    if not cache:
+        return np.loadtxt(filename, dtype=dtype, ndmin=2)
+    if not _cache_is_valid(filename, dtype=dtype, verify_hash=verify_hash):
+        try:
+            convert_forceout(filename, dtype=dtype)
+        except OSError as e:
+            warnings.warn("Could not cache {0} ({1}), "
+                        "parsing text instead".format(filename, e))
+            return np.loadtxt(filename, dtype=dtype, ndmin=2)
+    return np.load(filename + CACHE_SUFFIX, mmap_mode='r')
+
+def load_forceout_metadata(filename):
+    """ Metadata of a cached forceout file, or None if there is no cache
+
+    Returns
+    -------
+    metadata : dict
+        'shape', 'dtype', 'column_steps' (difference between the first two
+        rows of each column, e.g. the timestep of a time column),
+        and the source file's 'size', 'mtime_ns', and 'sha1'
+    """
+    try:
+        with open(filename + METADATA_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def convert_forceout(filename, dtype=np.float64, chunk_size=100000):
+    """ Convert a forceout text file to its binary cache
+
+    The text is parsed in chunks, so memory does not scale with file size
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    n_rows = 0
+    n_cols = None
+    first_rows = []
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.raw',
+                                    delete=False) as raw:
+        try:
+            for chunk in _iter_text_chunks(filename, usecols=None,
+                                            chunk_size=chunk_size):
+                chunk = chunk.astype(dtype)
+                n_cols = chunk.shape[1]
+                n_rows += chunk.shape[0]
+                if len(first_rows) < 2:
+                    first_rows.extend(chunk[:2 - len(first_rows)])
+                chunk.tofile(raw)
+            raw.close()
+            if n_cols is None:
+                raise ValueError("No data in {}".format(filename))
+
+            tmp_npy = raw.name + CACHE_SUFFIX
+            out = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=dtype,
+                                        shape=(n_rows, n_cols), fortran_order=True)
+            rows = np.memmap(raw.name, dtype=dtype, mode='r',
+                            shape=(n_rows, n_cols))
+            for start in range(0, n_rows, chunk_size):
+                out[start:start + chunk_size] = rows[start:start + chunk_size]
+            out.flush()
+            del out, rows
+            os.replace(tmp_npy, filename + CACHE_SUFFIX)
+        finally:
+            if os.path.exists(raw.name):
+                os.remove(raw.name)
+
+    column_steps = [None] * n_cols
+    if len(first_rows) == 2:
+        column_steps = [float(b - a) for a, b in zip(*first_rows)]
+    metadata = _source_signature(filename)
+    metadata.update({'shape': [n_rows, n_cols],
+                    'dtype': np.dtype(dtype).str,
+                    'column_steps': column_steps})
+    _write_metadata(filename, metadata)
+    return metadata
+
+def _cache_is_valid(filename, dtype=np.float64, verify_hash=False):
+    """ Check the cache of filename against the source file """
+    metadata = load_forceout_metadata(filename)
+    if metadata is None or not os.path.isfile(filename + CACHE_SUFFIX):
+        return False
+    if metadata.get('dtype') != np.dtype(dtype).str:
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != metadata['size']:
+        return False
+    if stat.st_mtime_ns == metadata['mtime_ns'] and not verify_hash:
+        return True
+    # Same size but touched (or a check was requested), compare contents
+    if _sha1(filename) != metadata['sha1']:
+        return False
+    if stat.st_mtime_ns != metadata['mtime_ns']:
+        metadata['mtime_ns'] = stat.st_mtime_ns
+        try:
+            _write_metadata(filename, metadata)
+        except OSError:
+            pass
+    return True
+
+def source_sha1(filename):
+    """ sha1 of a forceout file's contents
+
+    Reuses the hash recorded in the binary cache when the cache is
+    still valid, so unchanged files are not re-read
+    """
+    if _cache_is_valid(filename):
+        return load_forceout_metadata(filename)['sha1']
+    return _sha1(filename)
+
+def _source_signature(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': _sha1(filename)}
+
+def _sha1(filename, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _write_metadata(filename, metadata):
+    """ Atomically write the metadata sidecar, through a temporary file
+    of its own so concurrent conversions never share a partial file """
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(mode='w', dir=directory, suffix='.tmp',
+                                    delete=False) as f:
+        json.dump(metadata, f)
+    os.replace(f.name, filename + METADATA_SUFFIX)
+
+def iter_forceout_chunks(filename, usecols=(0, 1), chunk_size=100000,
+                        cache=True):
+    """ Read a forceout file in fixed-size chunks
+
+    Parameters
+    ---------
+    filename : str
+        Whitespace-delimited text file, '#' lines are skipped
+    usecols : tuple of int, default=(0, 1)
+        Columns to keep, (0, 1) for condensed_forceout files
+        and (1, 2) for raw forceout files
+    chunk_size : int, default=100000
+        Maximum number of rows returned at once
+    cache : bool, default=True
+        If False, parse the text file without reading or writing the cache
+
+    Yields
+    ------
+    chunk : np.ndarray, shape=(<=chunk_size, len(usecols))
+
+    Notes
+    -----
+    Like `load_forceout`, a missing or stale binary cache is rebuilt first
+    (convert_forceout also works in chunks), then chunks are sliced from 
+    the memory map instead of parsing text
+    """
+    if cache and not _cache_is_valid(filename):
+        try:
+            convert_forceout(filename, chunk_size=chunk_size)
+        except OSError as e:
+            warnings.warn("Could not cache {0} ({1}), "
+                        "parsing text instead".format(filename, e))
+            cache = False
+    if cache:
+        data = np.load(filename + CACHE_SUFFIX, mmap_mode='r')
+        columns = slice(None) if usecols is None else list(usecols)
+        for start in range(0, data.shape[0], chunk_size):
+            yield np.asarray(data[start:start + chunk_size][:, columns])
+        return
+    for chunk in _iter_text_chunks(filename, usecols=usecols,
+                                    chunk_size=chunk_size):
+        yield chunk
+
+def _iter_text_chunks(filename, usecols=None, chunk_size=100000):
+    with open(filename) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            chunk = np.loadtxt(lines, usecols=usecols, ndmin=2)
+            if chunk.shape[0] > 0:
+                yield chunk
+
+# Columnar store of profiles from many sweeps
+# directory/manifest.json records the window coordinates, the unit of every
+# profile, and the sweeps in row order. Each profile is a raw float64 file
+# holding a C-ordered (n_sweeps, n_windows) array, so adding a sweep appends
+# one row per file and loading a profile is a single read
+
+PROFILE_MANIFEST = 'manifest.json'
+PROFILE_SUFFIX = '.f8'
+
+class ProfileStore(object):
+    """ Profiles of every sweep, aligned on a common set of windows
+
+    Parameters
+    ---------
+    directory : str
+    window_coordinates : np.ndarray, shape=(n_windows,), optional
+        Reaction coordinates of every window, required to create a store
+    units : dict, optional
+        Profile name -> unit string, e.g. {'free_energy': 'kilocalorie/mole'}.
+        Required to create a store
+    coordinate_unit : str, default='nanometer'
+    tolerance : float, default=0.1
+        How far (in coordinate_unit) a sweep's reaction coordinate may be
+        from a window's coordinate to count as that window
+
+    Notes
+    -----
+    Values are plain floats in the store's units. Appending writes the rows
+    first and the manifest last, so an interrupted append leaves at most an 
+    unlisted trailing row, which the next append overwrites
+    """
+    def __init__(self, directory, window_coordinates=None, units=None,
+                coordinate_unit='nanometer', tolerance=0.1):
+        self.directory = os.path.abspath(directory)
+        self.tolerance = tolerance
+        manifest_path = os.path.join(self.directory, PROFILE_MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if window_coordinates is not None and not np.allclose(
+                    window_coordinates, self.manifest['window_coordinates']):
+                raise ValueError("Window coordinates differ from those of "
+                                "the profile store in {}".format(self.directory))
+        else:
+            if window_coordinates is None or units is None:
+                raise ValueError("No profile store in {}, window_coordinates "
+                                "and units are needed to create one".format(
+                                                            self.directory))
+            os.makedirs(self.directory, exist_ok=True)
+            self.manifest = {'window_coordinates': [float(val) for val in 
+                                                    window_coordinates],
+                            'coordinate_unit': coordinate_unit,
+                            'units': dict(units), 'sweeps': []}
+            self._write_manifest()
+
+    @property
+    def sweeps(self):
+        return list(self.manifest['sweeps'])
+
+    @property
+    def units(self):
+        return dict(self.manifest['units'])
+
+    @property
+    def window_coordinates(self):
+        return np.array(self.manifest['window_coordinates'])
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + PROFILE_SUFFIX)
+
+    def _write_manifest(self):
+        with tempfile.NamedTemporaryFile(mode='w', dir=self.directory,
+                                        suffix='.tmp', delete=False) as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(f.name, os.path.join(self.directory, PROFILE_MANIFEST))
+
+    def append(self, sweep, reaction_coordinates, profiles):
+        """ Add one sweep's profiles, or replace them if sweep is stored
+
+        Parameters
+        ---------
+        sweep : str
+        reaction_coordinates : np.ndarray, shape=(n,)
+            Coordinates of the sweep's windows, in coordinate_unit
+        profiles : dict
+            Profile name -> np.ndarray, shape=(n,), in the store's units.
+            Windows the sweep does not have are stored as NaN
+
+        Returns
+        -------
+        missing : np.ndarray of int
+            Indices of the windows the sweep does not have
+        """
+        unknown = set(profiles) - set(self.manifest['units'])
+        if unknown:
+            raise ValueError("Unknown profiles {}".format(sorted(unknown)))
+        names = list(self.manifest['units'])
+        n_values = len(reaction_coordinates)
+        values = np.column_stack([np.asarray(profiles[name], dtype=np.float64)
+                                if name in profiles else np.full(n_values, np.nan)
+                                for name in names])
+        aligned, missing = misc.align_profiles(self.window_coordinates,
+                                    [reaction_coordinates], [values],
+                                    tolerance=self.tolerance)
+
+        sweeps = self.manifest['sweeps']
+        row = sweeps.index(sweep) if sweep in sweeps else len(sweeps)
+        row_bytes = aligned.shape[1] * np.dtype(np.float64).itemsize
+        for name, values in zip(names, aligned[0].T):
+            mode = 'r+b' if os.path.isfile(self._path(name)) else 'wb'
+            with open(self._path(name), mode) as f:
+                f.truncate(max(len(sweeps), row + 1) * row_bytes)
+                f.seek(row * row_bytes)
+                f.write(np.ascontiguousarray(values).tobytes())
+        if row == len(sweeps):
+            sweeps.append(sweep)
+        self._write_manifest()
+        return np.flatnonzero(missing[0])
+
+    def load(self, names=None):
+        """ Profiles of every stored sweep
+
+        Parameters
+        ---------
+        names : list of str, optional
+            Profiles to load, by default all of them
+
+        Returns
+        -------
+        profiles : dict
+            Profile name -> np.ndarray, shape=(n_sweeps, n_windows),
+            rows in the order of `sweeps`, NaN for missing windows
+        """
+        if names is None:
+            names = list(self.manifest['units'])
+        n_sweeps = len(self.manifest['sweeps'])
+        n_windows = len(self.manifest['window_coordinates'])
+        profiles = {}
+        for name in names:
+            if n_sweeps == 0:
+                profiles[name] = np.zeros((0, n_windows))
+                continue
+            profiles[name] = np.fromfile(self._path(name), dtype=np.float64,
+                        count=n_sweeps * n_windows).reshape(n_sweeps, n_windows)
+        return profiles
@@ -1,82 +1,213 @@
+from operator import attrgetter
+
 import numpy as np
 import simtk.unit as u
-def validate_quantity_type(array, desired_unit):
+def validate_quantity_type(array, desired_unit, return_mask=False, 
+                            drop_nan=True):
     """ Ensure that arrays are u.Quantity, but elements are just floats
     Parameters
     ---------
     array : some iterable
+        An array, a u.Quantity wrapping an array, or a list of u.Quantity
     desired_unit : simtk.Unit
+    return_mask : bool, default=False
+        If True, also return the boolean mask of non-NaN elements 
+    drop_nan : bool, default=True
+        If True, NaN elements are removed. Pass False with return_mask=True
+        to keep several arrays aligned by combining their masks
 
     Returns
     -------
     array : array in correct form
+    mask : np.ndarray of bool, only if return_mask
+        True where the input element was not NaN
     """
-    if isinstance(array, u.Quantity):
-        array = array.in_units_of(desired_unit)
-    else:
-        array = array * desired_unit 
-    try:
-        if isinstance(array._value[0], u.Quantity):
-            array= array.unit*np.array([d._value for d in array._value])
-    except IndexError:
-        pass
-
-    array = array.unit * np.array([val for val in array._value 
-                                    if not np.isnan(val)])
+    values = _values_in_unit(array, desired_unit)
+    mask = ~np.isnan(values)
+    if drop_nan:
+        values = values[mask]
+    array = values * desired_unit
+    if return_mask:
+        return array, mask
     return array
 
+def _values_in_unit(array, desired_unit):
+    """ Convert an array, Quantity, or list of Quantity to floats 
+    in desired_unit, without touching elements one at a time where possible"""
+    unit = desired_unit
+    if isinstance(array, u.Quantity):
+        unit = array.unit
+        array = array._value
+
+    if (isinstance(array, (list, tuple)) and len(array) > 0 
+            and isinstance(array[0], u.Quantity)):
+        element_units = set(map(attrgetter('unit'), array))
+        if len(element_units) == 1:
+            unit = element_units.pop()
+            array = np.fromiter(map(attrgetter('_value'), array), dtype=float,
+                                count=len(array))
+        else:
+            array = np.fromiter((val.value_in_unit(desired_unit) for val in array),
+                                dtype=float, count=len(array))
+            unit = desired_unit
+
+    values = np.asarray(array, dtype=float)
+    if unit != desired_unit:
+        # Like Quantity.in_units_of, conversion_factor_to only asserts
+        if not unit.is_compatible(desired_unit):
+            raise TypeError("Unit {} is not compatible with Unit {}".format(
+                                                        unit, desired_unit))
+        values = values * unit.conversion_factor_to(desired_unit)
+    return values
+
 def symmetrize(data, zero_boundary_condition=False):
-    """Symmetrize a profile
+    """Symmetrize a profile, or a batch of profiles
     
     Params
     ------
-    data : np.ndarray, shape=(n,)
-        Data to be symmetrized
+    data : np.ndarray, shape=(n,) or (n_profiles, n)
+        Data to be symmetrized, e.g. every bootstrap mean profile at once
     zero_boundary_condition : bool, default=False
         If True, shift the right half of the curve before symmetrizing
 
     Returns
     -------
-    dataSym : np.ndarray, shape=(n,)
+    dataSym : np.ndarray, shape=(n,) or (n_profiles, n)
         symmetrized data
-    dataSym_err : np.ndarray, shape=(n,)
+    dataSym_err : np.ndarray, shape=(n,) or (n_profiles, n)
         error estimate in symmetrized data
 
-    This function symmetrizes a 1D array. It also provides an error estimate
-    for each value, taken as the standard error between the "left" and "right"
-    values. The zero_boundary_condition shifts the "right" half of the curve 
-    such that the final value goes to 0. This should be used if the data is 
-    expected to approach zero, e.g., in the case of pulling a water molecule 
-    through one phase into bulk water.
+    This function symmetrizes along the last axis. It also provides an error 
+    estimate for each value, taken as the standard error between the "left" 
+    and "right" values. The zero_boundary_condition shifts the "right" half 
+    of the curve such that the final value goes to 0. This should be used if 
+    the data is expected to approach zero, e.g., in the case of pulling a 
+    water molecule through one phase into bulk water.
+    data is not modified
     """
-    n_windows = data.shape[0]
-    n_win_half = int(np.ceil(float(n_windows)/2))
     data = _check_nan(data)
-    dataSym = np.zeros_like(data)
-    dataSym_err = np.zeros_like(data)
-    shift = {True: data[-1], False: 0.0}
-    for i, sym_val in enumerate(dataSym[:n_win_half]):
-        if np.isinf(data[i]):
-            data[i] = data[-(i+1)]
-        if np.isinf(data[-(i+1)]):
-            data[-(i+1)] = data[i]
-        val = 0.5 * (data[i] + data[-(i+1)])
-        err = np.std([data[i], data[-(i+1)] - shift[zero_boundary_condition]]) / np.sqrt(2)
-        dataSym[i], dataSym_err[i] = val, err
-        dataSym[-(i+1)], dataSym_err[-(i+1)] = val, err        
+    shift = data[..., -1:] if zero_boundary_condition else 0.0
+    data = _fill_from_mirror(data, np.isinf)
+    # Pair every window with its mirror image, left half value first
+    left_half = _left_half(data.shape[-1])
+    left = np.where(left_half, data, data[..., ::-1])
+    right = np.where(left_half, data[..., ::-1], data)
+    dataSym = 0.5 * (left + right)
+    dataSym_err = np.std(np.stack((left, right - shift)), axis=0) / np.sqrt(2)
     if zero_boundary_condition:
-        dataSym[:] -= dataSym[0]
+        dataSym = dataSym - dataSym[..., :1]
     return dataSym, dataSym_err
 
 def _check_nan(data):
     """ Given an array of data to be symmetrized, replace nans with counterparts """
+    return _fill_from_mirror(np.asarray(data, dtype=float), np.isnan)
+
+def _left_half(n_windows):
+    """ Mask of the first ceil(n/2) windows """
+    return np.arange(n_windows) < int(np.ceil(float(n_windows)/2))
+
+def _fill_from_mirror(data, is_bad):
+    """ Replace bad values with their mirror image along the last axis,
+    filling the left half first, so a pair of bad values stays bad """
+    left_half = _left_half(data.shape[-1])
+    data = np.where(left_half & is_bad(data), data[..., ::-1], data)
+    return np.where(~left_half & is_bad(data), data[..., ::-1], data)
+
+
+def align_profiles(window_coordinates, reaction_coordinates, profiles,
+                    tolerance=0.1):
+    """ Scatter the profiles of many sweeps onto a common set of windows
+
+    Params
+    ------
+    window_coordinates : array-like, shape=(n_windows,)
+        Coordinates of every window, e.g. from z_windows.out
+    reaction_coordinates : list of array-like
+        Coordinates of each sweep's windows, in the units of window_coordinates
+    profiles : list of array-like
+        Each sweep's values, shape=(n,) or (n, ...) matching its 
+        reaction_coordinates. Trailing dimensions align several profiles 
+        of a sweep at once
+    tolerance : float, default=0.1
+        How far a coordinate may be from its window
 
-    n_windows = data.shape[0]
-    n_win_half = int(np.ceil(float(n_windows)/2))
-    for i, sym_val in enumerate(data[:n_win_half]):
-        if np.isnan(sym_val):
-            data[i] = data[-(i+1)]
-        if np.isnan(data[-(i+1)]):
-            data[-(i+1)] = data[i]
-    return data
+    Returns
+    -------
+    aligned : np.ndarray, shape=(n_sweeps, n_windows, ...)
+        np.nan where a sweep has no window
+    missing : np.ndarray of bool, shape=(n_sweeps, n_windows)
+        True for the windows each sweep is missing
+
+    Because of the way equilibration protocol and how lammps handles fixes,
+    some tracers are constrained to windows outside the box, and that 
+    tracer/window is left out of that sweep, so some sweeps include extreme
+    windows and others do not. Every coordinate is matched to the nearest 
+    window with one searchsorted, and statistics over sweeps can then 
+    exclude the np.nan values.
+    Raises ValueError if a coordinate is farther than tolerance from every
+    window, or if two coordinates of one sweep match the same window
+    """
+    window_coordinates = np.asarray(window_coordinates, dtype=float)
+    n_windows = window_coordinates.shape[0]
+    lengths = [len(coordinates) for coordinates in reaction_coordinates]
+    coordinates = np.concatenate([np.asarray(coords, dtype=float).reshape(-1)
+                                for coords in reaction_coordinates])
+    values = np.concatenate([np.asarray(profile, dtype=float)
+                            for profile in profiles])
+    sweeps = np.repeat(np.arange(len(lengths)), lengths)
+
+    # Nearest window: the closer of the sorted neighbors on either side
+    order = np.argsort(window_coordinates, kind='stable')
+    sorted_windows = window_coordinates[order]
+    right = np.clip(np.searchsorted(sorted_windows, coordinates), 0, n_windows - 1)
+    left = np.maximum(right - 1, 0)
+    take_left = (np.abs(coordinates - sorted_windows[left]) <=
+                np.abs(coordinates - sorted_windows[right]))
+    nearest = np.where(take_left, left, right)
+    distance = np.abs(coordinates - sorted_windows[nearest])
+    unmatched = distance > tolerance
+    if np.any(unmatched):
+        raise ValueError("Reaction coordinates {} match no window".format(
+                                                    coordinates[unmatched]))
+    columns = order[nearest]
+    cells, counts = np.unique(sweeps * n_windows + columns, return_counts=True)
+    if np.any(counts > 1):
+        duplicated = cells[counts > 1]
+        raise ValueError("Several reaction coordinates of sweeps {} match "
+                        "windows {}".format(duplicated // n_windows,
+                                            window_coordinates[duplicated % n_windows]))
+
+    aligned = np.full((len(lengths), n_windows) + values.shape[1:], np.nan)
+    aligned[sweeps, columns] = values
+    missing = np.ones((len(lengths), n_windows), dtype=bool)
+    missing[sweeps, columns] = False
+    return aligned, missing
+
+def stack_timeseries(timeseries):
+    """ Stack ragged timeseries into a NaN-padded 2D array
 
+    Parameters
+    ---------
+    timeseries : list of array-like or u.Quantity
+        One timeseries per window, possibly of different lengths
+
+    Returns
+    -------
+    stacked : np.ndarray or u.Quantity, shape=(n_windows, max_length)
+        Rows padded at the end with np.nan. A Quantity is returned 
+        if the first timeseries is a Quantity
+    lengths : np.ndarray, shape=(n_windows,)
+        Number of valid frames in each row
+    """
+    unit = None
+    if isinstance(timeseries[0], u.Quantity):
+        unit = timeseries[0].unit
+        timeseries = [np.asarray(series.value_in_unit(unit)) 
+                        for series in timeseries]
+    lengths = np.array([len(series) for series in timeseries], dtype=int)
+    stacked = np.full((len(timeseries), np.max(lengths)), np.nan)
+    for row, series in zip(stacked, timeseries):
+        row[:len(series)] = series
+    if unit is not None:
+        stacked = stacked * unit
+    return stacked, lengths
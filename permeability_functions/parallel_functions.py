@@ -0,0 +1,257 @@
+import os
+import itertools
+
+import numpy as np
+import simtk.unit as u
+
+import permeability_functions.io_functions as io_functions
+import permeability_functions.cache_functions as cache_functions
+import permeability_functions.misc as misc
+import permeability_functions.thermo_core as thermo_core
+import permeability_functions.thermo_functions as thermo_functions
+
+# Fan per-Sim FACF jobs out over a process pool.
+# Jobs only carry absolute paths and plain floats, so nothing depends on
+# the working directory and no Quantities are pickled between processes.
+# ProcessPoolExecutor is imported where the pool is made, so worker
+# processes importing this module skip multiprocessing's startup cost
+
+def find_sweep_windows(sweep_dir, n_sims=6):
+    """ Locate every window's forceout file in a sweep
+
+    Parameters
+    ---------
+    sweep_dir : str
+        Directory containing z_windows.out and Sim0..Sim{n_sims-1}
+    n_sims : int, default=6
+
+    Returns
+    -------
+    windows : list of (forceout_id, sim_dir) tuples
+
+    Notes
+    -----
+    Only the number of tracers in each Sim's tracers.out matters: its
+    i-th tracer samples window sim_number + i*n_sims
+    """
+    sweep_dir = os.path.abspath(sweep_dir)
+    windows = []
+    for sim_number in range(n_sims):
+        sim_dir = os.path.join(sweep_dir, 'Sim{}'.format(sim_number))
+        n_tracers = np.loadtxt(os.path.join(sim_dir, 'tracers.out'),
+                            dtype=int, ndmin=1).shape[0]
+        for i in range(n_tracers):
+            forceout_id = sim_number + (i*n_sims)
+            windows.append((forceout_id, sim_dir))
+    return windows
+
+def analyze_window(sim_dir, forceout_id, correlation_length=300.0, dstart=10,
+                    average_fraction=0.1, plateau_method='fixed',
+                    write_outputs=True, cache_dir=None):
+    """ Mean force, FACF integral, and mean force error of one window, without units
+
+    Parameters
+    ---------
+    sim_dir : str
+        Directory holding condensed_forceout{forceout_id}.dat, with time
+        in fs and force in kcal/(mol*angstrom)
+    forceout_id : int
+    correlation_length : float, default=300.0
+        In ps
+    dstart : int, default=10
+    average_fraction : float, default=0.1
+    plateau_method : str, default='fixed'
+        See thermo_core.integrate_facf_over_time. The plateau is found on
+        the full correlation_length FACF, which is what is written and cached
+    write_outputs : bool, default=True
+        Write meanforce{forceout_id}.dat and fcorr{forceout_id}.dat
+        like thermo_functions.analyze_force_timeseries
+    cache_dir : str, optional
+        Directory of a cache_functions.ResultCache. Results are looked up
+        by file contents and parameters before computing anything
+
+    Returns
+    -------
+    mean_force : float
+        kcal/(mol*angstrom), NaN if the forceout file does not exist
+    facf_integral : float
+        (kcal/(mol*angstrom))**2 * ps, NaN if the forceout file does not exist
+    mean_force_sem : float
+        Standard error of the mean force, kcal/(mol*angstrom), see
+        uncertainty_functions.mean_force_sem
+    """
+    mean_forces, facf_integrals, mean_force_sems = analyze_sim(sim_dir, [forceout_id],
+                    correlation_length=correlation_length, dstart=dstart,
+                    average_fraction=average_fraction,
+                    plateau_method=plateau_method,
+                    write_outputs=write_outputs, cache_dir=cache_dir)
+    return (float(mean_forces[0]), float(facf_integrals[0]),
+            float(mean_force_sems[0]))
+
+def analyze_sim(sim_dir, forceout_ids, correlation_length=300.0, dstart=10,
+                average_fraction=0.1, plateau_method='fixed',
+                write_outputs=True, cache_dir=None):
+    """ Mean forces, FACF integrals, and mean force errors of several windows of one Sim
+
+    Parameters are those of `analyze_window`, for every forceout id
+
+    Returns
+    -------
+    mean_forces : np.ndarray, shape=(n_ids,)
+    facf_integrals : np.ndarray, shape=(n_ids,)
+    mean_force_sems : np.ndarray, shape=(n_ids,)
+        NaN for windows whose forceout file does not exist
+
+    Notes
+    -----
+    Windows that are not in the cache share one
+    thermo_functions.analyze_force_timeseries_batch call (one per
+    timestep, if the Sim's windows were written with different ones)
+    """
+    params = {'correlation_length': correlation_length, 'dstart': dstart,
+            'average_fraction': average_fraction,
+            'plateau_method': plateau_method, 'estimator': 'fft'}
+    cache = cache_functions.ResultCache(cache_dir) if cache_dir else None
+    results = {}
+    keys = {}
+    to_compute = []
+    for forceout_id in forceout_ids:
+        filename = os.path.join(sim_dir,
+                                'condensed_forceout{}.dat'.format(forceout_id))
+        if not os.path.isfile(filename):
+            continue
+        if cache is not None:
+            keys[forceout_id] = cache.key(filename, **params)
+            results[forceout_id] = cache.get(keys[forceout_id])
+        if results.get(forceout_id) is None:
+            to_compute.append((forceout_id, io_functions.load_forceout(filename)))
+
+    # femtosecond to picosecond
+    dsteps = [(data[1, 0] - data[0, 0]) * 1e-3 for _, data in to_compute]
+    for dstep in sorted(set(dsteps)):
+        batch = [window for window, window_dstep in zip(to_compute, dsteps)
+                if window_dstep == dstep]
+        forces, lengths = misc.stack_timeseries([np.asarray(data[:, 1], dtype=float)
+                                                for _, data in batch])
+        mean_forces, _, facfs, facf_integrals, mean_force_sems = (
+                thermo_functions.analyze_force_timeseries_batch(
+                        np.array([0.0, dstep]) * u.picosecond,
+                        forces * thermo_functions.FORCE_UNIT, lengths=lengths,
+                        correlation_length=correlation_length * u.picosecond,
+                        dstart=dstart, average_fraction=average_fraction,
+                        plateau_method=plateau_method, return_sem=True))
+        facf_integrals = facf_integrals.value_in_unit(
+                                        thermo_functions.FACF_INTEGRAL_UNIT)
+        for i, (forceout_id, _) in enumerate(batch):
+            results[forceout_id] = {'mean_force': mean_forces._value[i],
+                                    'facf': facfs._value[i],
+                                    'facf_integral': facf_integrals[i],
+                                    'mean_force_sem': mean_force_sems._value[i],
+                                    'dstep': dstep}
+            if cache is not None:
+                cache.put(keys[forceout_id], **results[forceout_id])
+
+    mean_forces = np.full(len(forceout_ids), np.nan)
+    facf_integrals = np.full(len(forceout_ids), np.nan)
+    mean_force_sems = np.full(len(forceout_ids), np.nan)
+    for i, forceout_id in enumerate(forceout_ids):
+        result = results.get(forceout_id)
+        if result is None:
+            continue
+        mean_forces[i] = result['mean_force']
+        facf_integrals[i] = result['facf_integral']
+        mean_force_sems[i] = result['mean_force_sem']
+        if write_outputs:
+            dstep = float(result['dstep'])
+            time_intervals = np.arange(result['facf'].shape[0]) * dstep
+            np.savetxt(os.path.join(sim_dir, 'fcorr{}.dat'.format(forceout_id)),
+                        np.column_stack((time_intervals, result['facf'])))
+            np.savetxt(os.path.join(sim_dir, 'meanforce{}.dat'.format(forceout_id)),
+                        [result['mean_force']])
+    return mean_forces, facf_integrals, mean_force_sems
+
+def _analyze_sim_job(job):
+    """ Unpack a job tuple for Executor.map """
+    sim_dir, forceout_ids, kwargs = job
+    return analyze_sim(sim_dir, forceout_ids, **kwargs)
+
+def analyze_sweeps(sweep_dirs, n_sims=6, n_workers=None,
+                    correlation_length=300*u.picosecond, dstart=10,
+                    average_fraction=0.1, plateau_method='fixed',
+                    write_outputs=True, cache_dir=None, cache_max_bytes=2**30):
+    """ Analyze every window of every sweep in parallel
+
+    Parameters
+    ---------
+    sweep_dirs : list of str
+    n_sims : int, default=6
+    n_workers : int, optional
+        Number of worker processes, defaults to os.cpu_count().
+        With n_workers=1 everything runs in this process. There is one
+        job per Sim, so at most n_sims * len(sweep_dirs) workers are busy
+    correlation_length : u.Quantity
+    dstart, average_fraction, plateau_method, write_outputs, cache_dir
+        Passed to analyze_sim
+    cache_max_bytes : int, default=2**30
+        Size budget of the result cache, enforced after all jobs finish
+
+    Returns
+    -------
+    results : dict
+        sweep_dir -> (reaction_coordinates, window_forces,
+        window_facf_integrals, window_force_errors). The first three are
+        ready for thermo_functions.permeability_routine, and with the
+        standard errors of the mean forces for 
+        thermo_functions.compute_permeability_error.
+        Windows without a condensed forceout file are NaN
+    """
+    kwargs = {'correlation_length': correlation_length.value_in_unit(u.picosecond),
+            'dstart': dstart, 'average_fraction': average_fraction,
+            'plateau_method': plateau_method,
+            'write_outputs': write_outputs,
+            'cache_dir': cache_dir}
+    # One job per Sim, its windows share one batched FACF
+    jobs = []
+    job_sweeps = []
+    for sweep_dir in sweep_dirs:
+        windows = find_sweep_windows(sweep_dir, n_sims=n_sims)
+        for sim_dir, sim_windows in itertools.groupby(windows,
+                                                    key=lambda window: window[1]):
+            jobs.append((sim_dir, [forceout_id for forceout_id, _ in sim_windows],
+                        kwargs))
+            job_sweeps.append(sweep_dir)
+
+    if n_workers == 1:
+        outputs = list(map(_analyze_sim_job, jobs))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        n_workers = n_workers or os.cpu_count()
+        chunksize = max(1, len(jobs) // (4*n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            outputs = list(executor.map(_analyze_sim_job, jobs,
+                                        chunksize=chunksize))
+
+    if cache_dir:
+        cache_functions.ResultCache(cache_dir, max_bytes=cache_max_bytes).evict()
+
+    results = {}
+    for sweep_dir in sweep_dirs:
+        reaction_coordinates = np.loadtxt(os.path.join(sweep_dir, 'z_windows.out'))
+        n_windows = len(reaction_coordinates)
+        results[sweep_dir] = (reaction_coordinates * u.nanometer,
+                            np.full(n_windows, np.nan), np.full(n_windows, np.nan),
+                            np.full(n_windows, np.nan))
+    for sweep_dir, (sim_dir, forceout_ids, _), (mean_forces, facf_integrals,
+                            mean_force_sems) in zip(job_sweeps, jobs, outputs):
+        _, window_forces, window_facf_integrals, window_force_errors = results[sweep_dir]
+        window_forces[forceout_ids] = mean_forces
+        window_facf_integrals[forceout_ids] = facf_integrals
+        window_force_errors[forceout_ids] = mean_force_sems
+
+    force_unit = u.kilocalorie/(u.mole*u.angstrom)
+    for sweep_dir, (reaction_coordinates, window_forces, window_facf_integrals,
+                    window_force_errors) in results.items():
+        results[sweep_dir] = (reaction_coordinates, window_forces * force_unit,
+                        window_facf_integrals * force_unit**2 * u.picosecond,
+                        window_force_errors * force_unit)
+    return results
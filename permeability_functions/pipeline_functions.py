@@ -0,0 +1,230 @@
+import os
+
+import numpy as np
+import simtk.unit as u
+
+import permeability_functions.parallel_functions as parallel_functions
+import permeability_functions.thermo_core as thermo_core
+import permeability_functions.thermo_functions as thermo_functions
+
+class PermeabilityPipeline(object):
+    """ Keep one sweep's profiles up to date as its windows change
+
+    Parameters
+    ---------
+    sweep_dir : str
+        Directory containing z_windows.out and Sim0..Sim{n_sims-1}
+    n_sims : int, default=6
+    correlation_length : u.Quantity, default=300 ps
+    dstart : int, default=10
+    average_fraction : float, default=0.1
+    plateau_method : str, default='fixed'
+        As in parallel_functions.analyze_window
+    cache_dir : str, optional
+        Directory of a cache_functions.ResultCache shared with
+        parallel_functions.analyze_sweeps
+    kb, temp : u.Quantity
+        As in thermo_functions.permeability_routine
+
+    Notes
+    -----
+    Each window's forceout file is tracked by size and mtime. `update`
+    recomputes the FACF of changed windows only, then patches the profile
+    chain instead of rebuilding it: the free energy is a cumulative
+    integral, so a changed mean force only changes the two trapezoid
+    segments around its window, and every later window shifts by the
+    same amount. Only the resistance integrand of affected windows, and
+    the trapezoid segments next to them, are recomputed.
+    If the set of windows with data changes, the chain is rebuilt.
+    """
+    def __init__(self, sweep_dir, n_sims=6, correlation_length=300*u.picosecond,
+                dstart=10, average_fraction=0.1, plateau_method='fixed',
+                cache_dir=None,
+                kb=1.987e-3 * u.kilocalorie / (u.mole * u.kelvin),
+                temp=305*u.kelvin):
+        self.sweep_dir = os.path.abspath(sweep_dir)
+        self.n_sims = n_sims
+        self.window_kwargs = {
+                'correlation_length': correlation_length.value_in_unit(u.picosecond),
+                'dstart': dstart, 'average_fraction': average_fraction,
+                'plateau_method': plateau_method,
+                'cache_dir': cache_dir}
+        self.kb = kb
+        self.temp = temp
+        self.kbt = (kb*temp).value_in_unit(thermo_functions.ENERGY_UNIT)
+
+        reaction_coordinates = np.loadtxt(os.path.join(self.sweep_dir, 'z_windows.out'))
+        self.reaction_coordinates = (reaction_coordinates * u.nanometer).value_in_unit(
+                                                    thermo_functions.LENGTH_UNIT)
+        n_windows = self.reaction_coordinates.shape[0]
+        self.mean_forces = np.full(n_windows, np.nan)
+        self.facf_integrals = np.full(n_windows, np.nan)
+        self.mean_force_errors = np.full(n_windows, np.nan)
+        self._signatures = {}
+
+        self._mask = None
+        self._fe_profile = None
+        self._diffusion_profile = None
+        self._resistance_profile = None
+        self._resistance_segments = None
+        self._resistance_integral = None
+
+    def changed_windows(self):
+        """ Windows whose forceout file is new, modified, or removed since the last update
+
+        Returns
+        -------
+        changed : dict
+            forceout_id -> (sim_dir, signature), signature is None
+            for a file that was removed
+        """
+        changed = {}
+        for forceout_id, sim_dir in parallel_functions.find_sweep_windows(
+                                        self.sweep_dir, n_sims=self.n_sims):
+            try:
+                stat = os.stat(os.path.join(sim_dir,
+                            'condensed_forceout{}.dat'.format(forceout_id)))
+            except FileNotFoundError:
+                # Not written yet, or removed since the last update
+                signature = None
+            else:
+                signature = (stat.st_size, stat.st_mtime_ns)
+            if self._signatures.get(forceout_id) != signature:
+                changed[forceout_id] = (sim_dir, signature)
+        return changed
+
+    def update(self):
+        """ Recompute changed windows and patch the profiles
+
+        Returns
+        -------
+        changed : list of int
+            forceout ids that were recomputed
+        """
+        changed = self.changed_windows()
+        old_forces = self.mean_forces.copy()
+        old_facf_integrals = self.facf_integrals.copy()
+        for forceout_id, (sim_dir, signature) in changed.items():
+            if signature is None:
+                # The window's data is gone, the chain is rebuilt without it
+                self.mean_forces[forceout_id] = np.nan
+                self.facf_integrals[forceout_id] = np.nan
+                self.mean_force_errors[forceout_id] = np.nan
+                del self._signatures[forceout_id]
+                continue
+            mean_force, facf_integral, mean_force_error = (
+                    parallel_functions.analyze_window(sim_dir, forceout_id,
+                                                    **self.window_kwargs))
+            self.mean_forces[forceout_id] = mean_force
+            self.facf_integrals[forceout_id] = facf_integral
+            self.mean_force_errors[forceout_id] = mean_force_error
+            self._signatures[forceout_id] = signature
+
+        mask = ~np.isnan(self.mean_forces) & ~np.isnan(self.facf_integrals)
+        if self._mask is None or np.any(mask != self._mask):
+            self._rebuild(mask)
+        elif changed:
+            self._patch(old_forces[mask], old_facf_integrals[mask])
+        return sorted(changed)
+
+    def _rebuild(self, mask):
+        """ Compute the whole profile chain over the windows in mask """
+        self._mask = mask
+        x = self.reaction_coordinates[mask]
+        self._fe_profile = thermo_core.compute_free_energy_profile(
+                                            self.mean_forces[mask], x)
+        self._diffusion_profile = thermo_core.compute_diffusion_coefficient(
+                                            self.facf_integrals[mask], kbt=self.kbt)
+        self._resistance_profile = (np.exp(self._fe_profile/self.kbt) /
+                                    self._diffusion_profile)
+        self._resistance_segments = _trapz_segments(self._resistance_profile, x)
+        self._resistance_integral = np.sum(self._resistance_segments)
+
+    def _patch(self, old_forces, old_facf_integrals):
+        """ Update the profile chain for windows whose inputs changed """
+        x = self.reaction_coordinates[self._mask]
+        new_forces = self.mean_forces[self._mask]
+        new_facf_integrals = self.facf_integrals[self._mask]
+        n_windows = x.shape[0]
+
+        # Free energy: redo trapezoid segments next to changed forces,
+        # every later window shifts by the cumulative change
+        affected = np.zeros(n_windows, dtype=bool)
+        force_changed = np.flatnonzero(new_forces != old_forces)
+        segments = _neighboring_segments(force_changed, n_windows)
+        if segments.shape[0] > 0:
+            delta = np.zeros(n_windows)
+            delta[segments + 1] = -0.5 * ((new_forces[segments] + new_forces[segments + 1])
+                                        - (old_forces[segments] + old_forces[segments + 1])
+                                        ) * (x[segments + 1] - x[segments])
+            start = segments[0] + 1
+            self._fe_profile[start:] += np.cumsum(delta[start:])
+            affected[start:] = True
+
+        # Diffusion only depends on each window's own FACF integral
+        diffusion_changed = np.flatnonzero(new_facf_integrals != old_facf_integrals)
+        self._diffusion_profile[diffusion_changed] = thermo_core.compute_diffusion_coefficient(
+                                new_facf_integrals[diffusion_changed], kbt=self.kbt)
+        affected[diffusion_changed] = True
+
+        # Resistance: new integrand where G or D changed,
+        # then only the trapezoid segments touching those windows
+        affected = np.flatnonzero(affected)
+        if affected.shape[0] == 0:
+            return
+        self._resistance_profile[affected] = (np.exp(self._fe_profile[affected]/self.kbt)
+                                            / self._diffusion_profile[affected])
+        segments = _neighboring_segments(affected, n_windows)
+        old_contribution = np.sum(self._resistance_segments[segments])
+        self._resistance_segments[segments] = 0.5 * (
+                self._resistance_profile[segments] + self._resistance_profile[segments + 1]
+                ) * (x[segments + 1] - x[segments])
+        self._resistance_integral += (np.sum(self._resistance_segments[segments])
+                                    - old_contribution)
+
+    def results(self):
+        """ Profiles in the same form as thermo_functions.permeability_routine """
+        mask = self._mask
+        LENGTH_UNIT = thermo_functions.LENGTH_UNIT
+        TIME_UNIT = thermo_functions.TIME_UNIT
+        DIFFUSION_UNIT = thermo_functions.DIFFUSION_UNIT
+        reaction_coordinates = (self.reaction_coordinates[mask] * LENGTH_UNIT).in_units_of(
+                                                                        u.nanometer)
+        mean_forces = self.mean_forces[mask] * thermo_functions.FORCE_UNIT
+        facf_integrals = self.facf_integrals[mask] * thermo_functions.FACF_INTEGRAL_UNIT
+        fe_profile = self._fe_profile * thermo_functions.ENERGY_UNIT
+        diffusion_profile = (self._diffusion_profile * DIFFUSION_UNIT).in_units_of(
+                                                        u.centimeter**2/u.second)
+        resistance_profile = (self._resistance_profile / DIFFUSION_UNIT).in_units_of(
+                                                        u.second/u.centimeter**2)
+        resistance_integral = (self._resistance_integral * TIME_UNIT/LENGTH_UNIT).in_units_of(
+                                                        u.second/u.centimeter)
+        permeability_profile = thermo_functions.compute_permeability(
+                            resistance_profile).in_units_of(u.centimeter**2/u.second)
+        permeability_integral = thermo_functions.compute_permeability(
+                            resistance_integral).in_units_of(u.centimeter/u.second)
+        return (reaction_coordinates, mean_forces, facf_integrals, fe_profile,
+                diffusion_profile, resistance_profile, resistance_integral,
+                permeability_profile, permeability_integral)
+
+    def errors(self):
+        """ Uncertainties of the profiles, as in thermo_functions.compute_permeability_error
+
+        Every free energy depends on all earlier mean force errors,
+        so these are recomputed in full rather than patched """
+        mask = self._mask
+        return thermo_functions.compute_permeability_error(
+                self.reaction_coordinates[mask] * thermo_functions.LENGTH_UNIT,
+                self.mean_forces[mask] * thermo_functions.FORCE_UNIT,
+                self.facf_integrals[mask] * thermo_functions.FACF_INTEGRAL_UNIT,
+                self.mean_force_errors[mask] * thermo_functions.FORCE_UNIT,
+                kb=self.kb, temp=self.temp)
+
+def _trapz_segments(y, x):
+    """ Contribution of each interval to the trapezoid integral of y over x """
+    return 0.5 * (y[1:] + y[:-1]) * np.diff(x)
+
+def _neighboring_segments(windows, n_windows):
+    """ Sorted trapezoid segments touching any of the given windows """
+    segments = np.unique(np.concatenate((windows - 1, windows)))
+    return segments[(segments >= 0) & (segments < n_windows - 1)]
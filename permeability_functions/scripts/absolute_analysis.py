@@ -1,52 +1,73 @@
 import os
-import pdb
-import glob
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
 import permeability_functions.thermo_functions as thermo_functions
 import permeability_functions.misc as misc
-import numpy as np
+import permeability_functions.parallel_functions as parallel_functions
+import permeability_functions.io_functions as io_functions
 import simtk.unit as u
+
+def analyze_sweep(sweep_result):
+    """ Profiles of one sweep of parallel_functions.analyze_sweeps
+
+    Returns the outputs of thermo_functions.permeability_routine, followed by
+    the error of the permeability integral. Windows that are NaN in 
+    sweep_result are dropped from both
+    """
+    (reaction_coordinates, window_forces, window_facf_integrals,
+                window_force_errors) = sweep_result
+    permeability_error = thermo_functions.compute_permeability_error(
+                reaction_coordinates, window_forces, window_facf_integrals,
+                window_force_errors)[-1]
+    return thermo_functions.permeability_routine(reaction_coordinates,
+                window_forces, window_facf_integrals) + (permeability_error,)
+
 def main():
-    all_sweeps = [thing for thing in os.listdir() is os.path.isdir(thing) and 'cache' not in thing]
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+
     curr_dir = os.getcwd()
+    # Profiles of every sweep go to one store, one row per sweep
+    store_dir = os.path.join(curr_dir, 'profiles')
+    all_sweeps = [os.path.join(curr_dir, thing) for thing in os.listdir(curr_dir) 
+                    if os.path.isdir(thing) and 'cache' not in thing
+                    and os.path.join(curr_dir, thing) != store_dir]
     n_sims = 6
+    # None uses every core, 1 runs serially
+    n_workers = None
+    # Windows already analyzed with the same data and parameters are reused
+    cache_dir = os.path.join(curr_dir, 'facf_cache')
+
+    # Every window of every sweep is one job, no chdir needed
+    sweep_results = parallel_functions.analyze_sweeps(all_sweeps, n_sims=n_sims,
+                                                    n_workers=n_workers,
+                                                    cache_dir=cache_dir)
+    profile_units = {'free_energy': u.kilocalorie/u.mole,
+                    'diffusion': u.centimeter**2/u.second,
+                    'resistance': u.second/u.centimeter**2,
+                    'permeability': u.centimeter**2/u.second}
+    window_coordinates = sweep_results[all_sweeps[0]][0]
+    store = io_functions.ProfileStore(store_dir,
+                    window_coordinates=window_coordinates.value_in_unit(u.nanometer),
+                    units={name: str(unit) for name, unit in profile_units.items()})
     for sweep in all_sweeps:
         print(sweep)
-        os.chdir(os.path.join(curr_dir, sweep))
-        reaction_coordinates = np.loadtxt('z_windows.out') * u.nanometer
-        n_windows = len(reaction_coordinates)
-        window_forces = np.zeros(n_windows)
-        window_facf_integrals = np.zeros(n_windows)
-        for sim_number in range(n_sims):
-            tracers = np.loadtxt('Sim{0}/tracers.out'.format(sim_number), dtype=int) - 1
-            for i,tracerid in enumerate(tracers):
-                forceout_id = sim_number + (i*n_sims)
-                data = np.loadtxt('Sim{0}/condensed_forceout{1}.dat'.format(sim_number, forceout_id))
-                times = data[:,0] * u.femtosecond
-                forces = data[:,1] * u.kilocalorie/(u.mole*u.angstrom)
-                mean_force , time_intervals, facf = thermo_functions.analyze_force_timeseries(
-                        times, forces, 
-                        meanf_name='Sim{0}/meanforce{1}.dat'.format(sim_number, forceout_id), 
-                        fcorr_name='Sim{0}/fcorr{1}.dat'.format(sim_number, forceout_id))
-                intF, intFval = thermo_functions.integrate_facf_over_time(time_intervals, 
-                                                                            facf)
-                window_forces[forceout_id] = mean_force._value
-                window_facf_integrals[forceout_id] = intFval._value
-        
-        
+        # Windows missing from the sweep are dropped from the results
         (reaction_coordinates, mean_forces, facf_integrals, fe_profile, 
                     diffusion_profile, resistance_profile, resistance_integral, 
-                    permeability_profile, permeability_integral) = thermo_functions.permeability_routine(reaction_coordinates, window_forces, window_facf_integrals)
-        
-        np.savetxt('diffusion_profile.dat', np.column_stack((reaction_coordinates, diffusion_profile)))
-        np.savetxt('free_energy_profile.dat', np.column_stack((reaction_coordinates, fe_profile)))
-        np.savetxt('resistance_profile.dat', np.column_stack((reaction_coordinates, resistance_profile)))
-        np.savetxt('permeability_profile.dat', np.column_stack((reaction_coordinates, permeability_profile)))
+                    permeability_profile, permeability_integral,
+                    permeability_error) = analyze_sweep(sweep_results[sweep])
         
+        profiles = {'free_energy': fe_profile, 'diffusion': diffusion_profile,
+                    'resistance': resistance_profile,
+                    'permeability': permeability_profile}
+        missing = store.append(os.path.basename(sweep),
+                    reaction_coordinates.value_in_unit(u.nanometer),
+                    {name: profile.value_in_unit(profile_units[name])
+                        for name, profile in profiles.items()})
+        if missing.shape[0] > 0:
+            print("Missing windows {}".format(missing))
         
-        print(permeability_integral)
+        print("{} +/- {}".format(permeability_integral, permeability_error))
     
     # Plotting
     fig, ax = plt.subplots(2,1)
@@ -64,7 +85,7 @@ def main():
     ax[1].set_xlabel("Reaction Coordinate ({})".format(reaction_coordinates.unit))
     ax[1].set_ylabel("Diffusion ({})".format(diffusion_profile.unit))
     fig.tight_layout()
-    fig.savefig('profiles.png')
+    fig.savefig(os.path.join(sweep, 'profiles.png'))
     plt.close(fig)
     
 if __name__ == "__main__":
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import plot_ay
 plot_ay.setDefaults()
 import bilayer_analysis_functions
+import permeability_functions.topology_functions as topology_functions
 
 ###############################
 ## From permeability simulations,
@@ -31,9 +32,11 @@ def main():
             print("Converting in {}".format((sweep,sim)))
             trajfile, grofile = prepare_traj(trajname='combined_nopbc.xtc')
             traj = mdtraj.load(trajfile, top=grofile)
+            topology_metadata = topology_functions.TopologyMetadata(grofile,
+                                cache_dir=os.path.join(curr_dir, 'topology_cache'))
             print("Analyzing in {}".format((sweep,sim)))
             s2list = compute_disorder(traj)
-            aptlist = compute_packing(traj)
+            aptlist = compute_packing(traj, topology_metadata=topology_metadata)
             all_s2.append(s2list)
             all_apt.append(aptlist)
 
@@ -83,12 +86,15 @@ def compute_disorder(traj):
         s2list = np.loadtxt('s2_permeation.dat')
     return s2list
 
-def compute_packing(traj):
+def compute_packing(traj, topology_metadata=None):
     """ Measure APT frame by frame """
     if not os.path.isfile("apt_permeation.dat"):
         lipid_tails, _ = bilayer_analysis_functions.identify_groups(traj,
                 forcefield='charmm36')
-        n_lipid = len([res for res in traj.topology.residues if not res.is_water])
+        if topology_metadata is None:
+            n_lipid = len([res for res in traj.topology.residues if not res.is_water])
+        else:
+            n_lipid = int(np.sum(~topology_metadata.water_residues()))
         n_lipid_tails = len(lipid_tails.keys())
         n_tails_per_lipid = n_lipid_tails/n_lipid
 
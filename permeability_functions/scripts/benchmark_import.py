@@ -0,0 +1,82 @@
+import sys
+import argparse
+import subprocess
+
+###############################
+## Guard the import time of the package
+## Every module is imported in a fresh interpreter, after numpy and
+## simtk.unit (required dependencies, loaded by every entry point anyway),
+## so timings are the package's own cost. No module may pull in any of the
+## optional trajectory/grid extras, and the thermo/statistics core,
+## which every per-window worker process imports, must stay under the
+## budget. Exits nonzero if any module fails a check
+###############################
+
+core_modules = ['permeability_functions.thermo_core',
+                'permeability_functions.thermo_functions',
+                'permeability_functions.uncertainty_functions',
+                'permeability_functions.misc',
+                'permeability_functions.io_functions',
+                'permeability_functions.cache_functions',
+                'permeability_functions.bootstrap_functions',
+                'permeability_functions.parallel_functions']
+
+other_modules = ['permeability_functions.pipeline_functions',
+                'permeability_functions.spatial_functions',
+                'permeability_functions.topology_functions',
+                'permeability_functions.grid_functions']
+
+optional_extras = ['mdtraj', 'scipy', 'grid_analysis',
+                    'bilayer_analysis_functions', 'matplotlib']
+
+child_code = """
+import sys
+import time
+import numpy
+import simtk.unit
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(','.join(name for name in {extras!r} if name in sys.modules))
+"""
+
+def time_import(module, n_repeats=5):
+    """ Fastest import time (s) over fresh interpreters, and any optional
+    extras the import loaded """
+    timings = []
+    for _ in range(n_repeats):
+        output = subprocess.check_output([sys.executable, '-c',
+                    child_code.format(module=module, extras=optional_extras)],
+                    universal_newlines=True)
+        elapsed, extras = output.splitlines()
+        timings.append(float(elapsed))
+    return min(timings), [name for name in extras.split(',') if name]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=50.0,
+                        help='Maximum import time per core module, in ms beyond '
+                            'numpy and simtk.unit')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    failed = []
+    for module in core_modules + other_modules:
+        elapsed, extras = time_import(module, n_repeats=args.repeats)
+        status = 'ok'
+        if module in core_modules and elapsed*1e3 > args.budget:
+            status = 'OVER BUDGET'
+        if extras:
+            status = 'imports {}'.format(', '.join(extras))
+        if status != 'ok':
+            failed.append(module)
+        print("{0:<45s} {1:8.1f} ms  {2}".format(module, elapsed*1e3, status))
+
+    if failed:
+        print("{0} module(s) failed the import checks ({1} ms budget)".format(
+                                                    len(failed), args.budget))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
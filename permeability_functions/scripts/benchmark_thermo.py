@@ -0,0 +1,81 @@
+import timeit
+import numpy as np
+import scipy.integrate
+import simtk.unit as u
+
+import permeability_functions.thermo_functions as thermo_functions
+import permeability_functions.thermo_core as thermo_core
+import permeability_functions.misc as misc
+
+###############################
+## Compare permeability_routine end-to-end:
+## the original Quantity-carrying chain, the unit-converting
+## wrapper in thermo_functions, and the unit-free thermo_core
+###############################
+
+n_windows = 35
+n_repeats = 50
+
+def legacy_permeability_routine(reaction_coordinates, mean_forces, facf_integrals,
+                                kb=1.987e-3 * u.kilocalorie / (u.mole * u.kelvin),
+                                temp=305*u.kelvin):
+    """ The pre-thermo_core chain, carrying units through every step """
+    cumtrapz = getattr(scipy.integrate, 'cumtrapz', None) or scipy.integrate.cumulative_trapezoid
+    trapz = getattr(scipy.integrate, 'trapz', None) or scipy.integrate.trapezoid
+    force_unit = u.kilocalorie/(u.mole*u.angstrom)
+    reaction_coordinates = misc.validate_quantity_type(reaction_coordinates, u.nanometer)
+    mean_forces = misc.validate_quantity_type(mean_forces, force_unit)
+    facf_integrals = misc.validate_quantity_type(facf_integrals,
+                                                force_unit**2*u.picosecond)
+
+    rc_angstrom = misc.validate_quantity_type(reaction_coordinates, u.angstrom)
+    fe_profile = -cumtrapz(mean_forces._value, x=rc_angstrom._value,
+                        initial=0)*mean_forces.unit*rc_angstrom.unit
+    diffusion_profile = ((kb*temp)**2/facf_integrals).in_units_of(u.centimeter**2/u.second)
+
+    fe_profile = misc.validate_quantity_type(fe_profile, u.kilocalorie/u.mole)
+    diffusion_profile = misc.validate_quantity_type(diffusion_profile,
+                                                    u.centimeter**2/u.second)
+    integrand = np.exp(fe_profile/(kb*temp))/diffusion_profile
+    resistance_integral = trapz(integrand._value,
+                        x=reaction_coordinates._value)*reaction_coordinates.unit/diffusion_profile.unit
+
+    permeability_profile = (1/integrand).in_units_of(u.centimeter**2/u.second)
+    permeability_integral = (1/resistance_integral).in_units_of(u.centimeter/u.second)
+    return fe_profile, diffusion_profile, permeability_profile, permeability_integral
+
+def main():
+    rng = np.random.RandomState(0)
+    force_unit = u.kilocalorie/(u.mole*u.angstrom)
+    reaction_coordinates = np.linspace(-3, 3, n_windows)
+    mean_forces = rng.normal(size=n_windows)
+    facf_integrals = rng.uniform(0.5, 5.0, size=n_windows)
+
+    # Relative analysis passes lists of Quantity scalars
+    quantity_inputs = ([val * u.nanometer for val in reaction_coordinates],
+                        [val * force_unit for val in mean_forces],
+                        [val * force_unit**2 * u.picosecond for val in facf_integrals])
+    array_inputs = (reaction_coordinates * u.nanometer, mean_forces * force_unit,
+                    facf_integrals * force_unit**2 * u.picosecond)
+    core_inputs = (reaction_coordinates * 10.0, mean_forces, facf_integrals)
+
+    legacy = legacy_permeability_routine(*array_inputs)
+    wrapped = thermo_functions.permeability_routine(*array_inputs)
+    core = thermo_core.permeability_routine(*core_inputs)
+    # 1 angstrom/ps is 1e4 cm/s
+    print("Permeability (cm/s): legacy {0}, wrapper {1}, core {2}".format(
+                        legacy[-1]._value, wrapped[-1]._value, core[-1]*1e4))
+
+    timings = [
+        ('legacy, Quantity lists', lambda: legacy_permeability_routine(*quantity_inputs)),
+        ('legacy, Quantity arrays', lambda: legacy_permeability_routine(*array_inputs)),
+        ('wrapper, Quantity lists', lambda: thermo_functions.permeability_routine(*quantity_inputs)),
+        ('wrapper, Quantity arrays', lambda: thermo_functions.permeability_routine(*array_inputs)),
+        ('thermo_core, floats', lambda: thermo_core.permeability_routine(*core_inputs)),
+        ]
+    for label, func in timings:
+        seconds = min(timeit.repeat(func, number=n_repeats, repeat=3)) / n_repeats
+        print("{0:<28s} {1:10.1f} us per call".format(label, seconds*1e6))
+
+if __name__ == "__main__":
+    main()
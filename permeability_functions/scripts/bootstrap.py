@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import permeability_functions.bootstrap_functions as bootstrap_functions
 import pdb
 import matplotlib
 matplotlib.use('agg')
@@ -12,17 +13,16 @@ n_bs = 100000
 matplotlib.rcParams['axes.titlesize'] = 24
 matplotlib.rcParams['axes.labelsize'] = 24
 
-regular_mean = np.mean(df['permeability'].values)
-regular_error = np.std(df['permeability'].values)/np.sqrt(len(df['permeability'].values))
-bootstrap = np.random.choice(df['permeability'].values, 
-        size=(n_bs, len(df['permeability'].values)))
-bootstrap_distribution = np.mean(bootstrap, axis=1)
-bootstrap_mean = np.mean(bootstrap_distribution)
-bootstrap_error = np.std(bootstrap_distribution)/np.sqrt(n_bs)
+permeabilities = df['permeability'].values
+regular_mean = np.mean(permeabilities)
+regular_error = np.std(permeabilities)/np.sqrt(len(permeabilities))
+linear_bootstrap = bootstrap_functions.bootstrap(permeabilities, n_bs=n_bs, ci=None)
+bootstrap_mean = linear_bootstrap.mean
+bootstrap_error = linear_bootstrap.std/np.sqrt(n_bs)
 
-log_data = np.log(df['permeability'].values)
-new_bootstrap = np.random.choice(log_data, size=(n_bs, len(log_data)))
-new_bootstrap_distribution = np.mean(new_bootstrap, axis=1)
+log_bootstrap = bootstrap_functions.bootstrap(permeabilities, n_bs=n_bs, log=True,
+                                            return_distribution=True)
+new_bootstrap_distribution = np.log(log_bootstrap.distribution)
 
 
 
@@ -35,11 +35,12 @@ fig.tight_layout()
 fig.savefig('bootstrap_logperm_distribution.png', transparent=True)
 plt.close(fig)
 
-new_bootstrap_mean = np.mean(new_bootstrap_distribution)
-bootstrap_log_error = np.std(np.exp(new_bootstrap_distribution))/np.sqrt(n_bs)
-log_mean = np.exp(new_bootstrap_mean)
+bootstrap_log_error = log_bootstrap.std/np.sqrt(n_bs)
+log_mean = log_bootstrap.mean
 print("Regular mean: {0} ({3}), "
         "\nbootstrap_mean: {1} ({4}), "
         "\nbootstrap_log_mean: {2} ({5})".format(
                     regular_mean, bootstrap_mean, log_mean,
                     regular_error, bootstrap_error, bootstrap_log_error))
+print("95% log-bootstrap interval: ({0}, {1})".format(log_bootstrap.ci_low,
+                                                    log_bootstrap.ci_high))
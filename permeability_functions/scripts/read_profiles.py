@@ -5,6 +5,7 @@ matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import permeability_functions.thermo_functions as thermo_functions
 import permeability_functions.misc as misc
+import permeability_functions.io_functions as io_functions
 import numpy as np
 import pandas as pd
 import simtk.unit as u
@@ -12,23 +13,22 @@ import os
 def main():
     curr_dir = os.getcwd()
 
-    #all_sweeps = [thing for thing in os.listdir() if os.path.isdir(thing) and 'sweep2' not in thing and 'sweep8' not in thing and 'sweep6' not in thing and '__pycache__' not in thing]
-    all_sweeps = [thing for thing in os.listdir() if os.path.isdir(thing) and '__pycache__' not in thing]
-    n_sims = 6
+    # Profiles of every sweep, written by absolute_analysis.py
+    store = io_functions.ProfileStore(os.path.join(curr_dir, 'profiles'))
+    profiles = store.load(['free_energy', 'diffusion'])
+    reaction_coordinates = store.window_coordinates * u.nanometer
     df = pd.DataFrame()
-    for sweep in all_sweeps:
-        os.chdir(os.path.join(curr_dir, sweep))
-        (reaction_coordinates, fe_profile) = (np.loadtxt('free_energy_profile.dat')[:,0],
-                                            np.loadtxt('free_energy_profile.dat')[:,1])
-
-        diffusion_profile = np.loadtxt('diffusion_profile.dat')[:,1]
-        reaction_coordinates =  reaction_coordinates * u.nanometer
-        fe_profile = fe_profile * u.kilocalorie/ (u.mole)
-        diffusion_profile = diffusion_profile * (u.centimeter**2)/u.second
+    for sweep, fe_profile, diffusion_profile in zip(store.sweeps,
+                                                    profiles['free_energy'],
+                                                    profiles['diffusion']):
+        # Drop windows this sweep did not sample
+        mask = ~np.isnan(fe_profile) & ~np.isnan(diffusion_profile)
+        fe_profile = fe_profile[mask] * u.kilocalorie/ (u.mole)
+        diffusion_profile = diffusion_profile[mask] * (u.centimeter**2)/u.second
         res_profile, res_integral = thermo_functions.compute_resistance_profile(
                                             fe_profile, 
                                             diffusion_profile,
-                                            reaction_coordinates)
+                                            reaction_coordinates[mask])
         permeability_integral = thermo_functions.compute_permeability(res_integral)
         permeability_integral = permeability_integral.in_units_of(u.centimeter/u.second)
         print(sweep, permeability_integral)
@@ -38,7 +38,6 @@ def main():
         temp_df = pd.DataFrame.from_dict(to_add)
         df = df.append(temp_df)
 
-    os.chdir(curr_dir)
     df.to_csv("permeability_summary.csv")
 
 
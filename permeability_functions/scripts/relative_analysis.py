@@ -10,6 +10,7 @@ import simtk.unit as u
 import permeability_functions.thermo_functions as thermo_functions
 import permeability_functions.grid_functions as grid_funcs
 import permeability_functions.misc as misc
+import permeability_functions.topology_functions as topology_functions
 
 def main():
     n_sims = 5
@@ -17,12 +18,18 @@ def main():
     leaflet_tuples = []
 
     for sim_number in range(n_sims):
-        traj = mdtraj.load('Sim{0}/trajectory.dcd'.format(sim_number), 
-                            top='Sim{0}/Stage4_Eq{0}.gro'.format(sim_number))
+        # Every Sim shares one topology, look up its metadata once
+        topology_metadata = topology_functions.TopologyMetadata(
+                            'Sim{0}/Stage4_Eq{0}.gro'.format(sim_number),
+                            cache_dir='topology_cache')
+        # Stream the trajectory in chunks so it never has to fit in memory
+        traj = mdtraj.iterload('Sim{0}/trajectory.dcd'.format(sim_number), 
+                            top='Sim{0}/Stage4_Eq{0}.gro'.format(sim_number),
+                            chunk=1000)
         tracers = np.loadtxt('Sim{0}/tracers.out'.format(sim_number), dtype=int) - 1
 
         d_from_local_i_list, d_from_leaflet_i_list = grid_funcs.distance_from_interface(
-                                                                    traj, tracers)
+                                    traj, tracers, topology_metadata=topology_metadata)
         d_from_local_i_list = misc.validate_quantity_type(d_from_local_i_list, 
                                                             u.nanometer)
         d_from_leaflet_i_list = misc.validate_quantity_type(d_from_leaflet_i_list, 
@@ -32,11 +39,11 @@ def main():
                                                 tracers,
                                                 d_from_local_i_list, d_from_leaflet_i_list)):
             forceout_id = sim_number + (i*n_sims)
-            data = np.loadtxt('Sim{0}/forceout{1}.dat'.format(sim_number, forceout_id))
-            times = data[:,1] * u.femtosecond
-            forces = data[:,2] * u.kilocalorie/(u.mole*u.angstrom)
-            mean_force , time_intervals, facf = thermo_functions.analyze_force_timeseries(
-                    times, forces, 
+            # Raw forceout files are large, stream them instead of np.loadtxt
+            mean_force , time_intervals, facf = thermo_functions.analyze_forceout_file(
+                    'Sim{0}/forceout{1}.dat'.format(sim_number, forceout_id),
+                    usecols=(1, 2), time_unit=u.femtosecond,
+                    force_unit=u.kilocalorie/(u.mole*u.angstrom),
                     meanf_name='Sim{0}/meanforce{1}.dat'.format(sim_number, i), 
                     fcorr_name='Sim{0}/fcorr{1}.dat'.format(sim_number, i))
             intF, intFval = thermo_functions.integrate_facf_over_time(time_intervals, facf)
@@ -0,0 +1,125 @@
+import numpy as np
+
+# Periodic spatial indexes over lipid headgroup atoms
+# An index is built from one reference frame and reused for every frame
+# of a chunk, so leaflet sorting and neighbor searches cost one build
+# per chunk instead of a scan per query
+# scipy is only imported when a HeadgroupIndex is built
+
+def sort_leaflets(z, midplane, exclusion=1.0):
+    """ Label atoms by leaflet from their heights
+
+    Parameters
+    ----------
+    z : np.ndarray, shape=(n_atoms,)
+    midplane : float
+    exclusion : float, default=1.0
+        Atoms closer than this to the midplane belong to neither leaflet
+
+    Returns
+    -------
+    labels : np.ndarray of int, shape=(n_atoms,)
+        -1 for the bottom leaflet, 1 for the top leaflet, 0 otherwise
+    """
+    labels = np.where(z < midplane, -1, 1)
+    labels[np.abs(z - midplane) <= exclusion] = 0
+    return labels
+
+def _wrap(xy, box):
+    """ Wrap points into [0, box), including values that round up to box """
+    wrapped = np.mod(xy, box)
+    return np.where(wrapped >= box, 0.0, wrapped)
+
+class HeadgroupIndex(object):
+    """ Spatial index over the headgroup atoms of both leaflets
+
+    Parameters
+    ----------
+    traj : mdtraj.Trajectory
+        The reference frame and box are taken from this trajectory (chunk)
+    headgroup_indices : array-like of int
+    frame : int, default=0
+        Reference frame
+    leaflets : tuple of (bot_leaflet, top_leaflet) atom indices, optional
+        By default, sorted from the reference frame around half its box
+        height, leaving out atoms within 1 nm of the midplane
+
+    Attributes
+    ----------
+    leaflets : tuple of np.ndarray
+        Atom indices of the bottom and top leaflets
+
+    Notes
+    -----
+    Periodic nearest-neighbor searches use one cKDTree per leaflet over
+    the wrapped xy coordinates, with boxsize set to the box.
+    Rebuild the index for each chunk of frames, so neighbors stay current
+    """
+    def __init__(self, traj, headgroup_indices, frame=0, leaflets=None):
+        from scipy.spatial import cKDTree
+
+        headgroup_indices = np.asarray(headgroup_indices, dtype=int)
+        xyz = traj.xyz[frame]
+        self.box = traj.unitcell_lengths[frame, :2].astype(float)
+        if leaflets is None:
+            midplane = traj.unitcell_lengths[frame, 2] / 2
+            labels = sort_leaflets(xyz[headgroup_indices, 2], midplane)
+            leaflets = (headgroup_indices[labels == -1],
+                        headgroup_indices[labels == 1])
+        self.leaflets = tuple(np.asarray(leaflet, dtype=int) for leaflet in leaflets)
+        self.trees = tuple(cKDTree(_wrap(xyz[leaflet, :2], self.box),
+                                    boxsize=self.box)
+                            for leaflet in self.leaflets)
+
+    def nearest(self, xy, k=4):
+        """ Nearest headgroups of each leaflet, by periodic xy distance
+
+        Parameters
+        ----------
+        xy : np.ndarray, shape=(..., 2)
+        k : int, default=4
+
+        Returns
+        -------
+        neighbors : tuple of np.ndarray, shape=(..., min(k, n_leaflet))
+            Atom indices of each leaflet's k nearest headgroups, or all of
+            them for a leaflet with fewer than k headgroups
+        """
+        xy = _wrap(xy, self.box)
+        neighbors = []
+        for leaflet, tree in zip(self.leaflets, self.trees):
+            leaflet_k = min(k, leaflet.shape[0])
+            if leaflet_k == 0:
+                neighbors.append(np.zeros(xy.shape[:-1] + (0,), dtype=int))
+                continue
+            _, positions = tree.query(xy, k=leaflet_k)
+            neighbors.append(leaflet[np.reshape(positions,
+                                                xy.shape[:-1] + (leaflet_k,))])
+        return tuple(neighbors)
+
+    def interface_heights(self, xyz, masses, xy, k=4):
+        """ Local interface heights from the nearest headgroups, per frame
+
+        Parameters
+        ----------
+        xyz : np.ndarray, shape=(n_frames, n_atoms, 3)
+            Frames to evaluate, e.g. every frame of this index's chunk
+        masses : np.ndarray, shape=(n_atoms,)
+        xy : np.ndarray, shape=(n_frames, n_points, 2)
+            Query points in each frame, e.g. tracer positions
+        k : int, default=4
+
+        Returns
+        -------
+        heights : np.ndarray, shape=(2, n_frames, n_points)
+            Mass-weighted mean z of the k nearest headgroups of the bottom
+            and top leaflets. Neighbors are searched among the reference
+            frame's positions, their heights taken from each frame
+        """
+        frames = np.arange(xyz.shape[0])[:, np.newaxis, np.newaxis]
+        heights = []
+        for neighbors in self.nearest(xy, k=k):
+            weights = masses[neighbors]
+            heights.append(np.sum(weights * xyz[frames, neighbors, 2], axis=-1) /
+                            np.sum(weights, axis=-1))
+        return np.stack(heights)
@@ -10,6 +10,7 @@ import simtk.unit as u
 import permeability_functions.thermo_functions as thermo_functions
 import permeability_functions.grid_functions as grid_funcs
 import permeability_functions.misc as misc
+import permeability_functions.io_functions as io_functions
 n_sims = 5
 sim_number =0 
 traj = mdtraj.load('Sim0/trajectory.dcd', top='Sim0/Stage4_Eq0.gro')
@@ -29,7 +30,7 @@ for i, (tracer, d_from_local_i, d_from_leaflet_i ) in enumerate(zip(
                                         tracers,
                                         d_from_local_i_list, d_from_leaflet_i_list)):
     forceout_id = sim_number + (i*n_sims)
-    data = np.loadtxt('forceout{}.txt'.format(forceout_id))
+    data = io_functions.load_forceout('forceout{}.txt'.format(forceout_id))
     times = data[:,1] * u.femtosecond
     forces = data[:,2] * u.kilocalorie/(u.mole*u.angstrom)
     mean_force , time_intervals, facf = thermo_functions.analyze_force_timeseries(
@@ -0,0 +1,363 @@
+import os
+import types
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import simtk.unit as u
+
+import permeability_functions.bootstrap_functions as bootstrap_functions
+import permeability_functions.grid_functions as grid_functions
+import permeability_functions.io_functions as io_functions
+import permeability_functions.misc as misc
+import permeability_functions.cache_functions as cache_functions
+import permeability_functions.parallel_functions as parallel_functions
+import permeability_functions.pipeline_functions as pipeline_functions
+import permeability_functions.spatial_functions as spatial_functions
+import permeability_functions.thermo_core as thermo_core
+import permeability_functions.thermo_functions as thermo_functions
+import permeability_functions.uncertainty_functions as uncertainty_functions
+
+# Exact-equivalence checks between the fast/streaming/cached code paths
+# and the straightforward computation they replace
+
+def _correlated_forces(n_frames=5000, seed=0):
+    """ AR(1) timeseries, correlated over ~10 frames """
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(size=n_frames)
+    forces = np.empty(n_frames)
+    forces[0] = noise[0]
+    for i in range(1, n_frames):
+        forces[i] = 0.9 * forces[i-1] + noise[i]
+    return forces + 3.0
+
+def test_streaming_acf_matches_batch_acf():
+    forces = _correlated_forces()
+    means, corr = thermo_core.batch_acf(forces[np.newaxis, :],
+                                        [forces.shape[0]], 200, dstart=10)
+    accumulator = thermo_core.StreamingACF(200, dstart=10)
+    for chunk in np.array_split(forces, 17):
+        accumulator.update(chunk)
+    mean, streamed = accumulator.result()
+    assert np.isclose(mean, means[0], rtol=0, atol=1e-12)
+    assert np.allclose(streamed, corr[0], rtol=0, atol=1e-10)
+
+def test_forceout_cache_matches_text(tmp_path):
+    filename = str(tmp_path / 'condensed_forceout0.dat')
+    forces = _correlated_forces(n_frames=1234)
+    np.savetxt(filename, np.column_stack((np.arange(1234) * 10.0, forces)))
+    text = np.loadtxt(filename)
+
+    chunks = list(io_functions.iter_forceout_chunks(filename, chunk_size=100))
+    assert (tmp_path / 'condensed_forceout0.dat.npy').exists()
+    assert np.array_equal(np.concatenate(chunks), text)
+    assert np.array_equal(io_functions.load_forceout(filename), text)
+
+def test_concurrent_forceout_conversions(tmp_path):
+    filename = str(tmp_path / 'condensed_forceout0.dat')
+    np.savetxt(filename, np.column_stack((np.arange(5000) * 10.0,
+                                        _correlated_forces(n_frames=5000))))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(io_functions.convert_forceout, [filename] * 8))
+    assert sorted(os.listdir(str(tmp_path))) == ['condensed_forceout0.dat',
+            'condensed_forceout0.dat.npy', 'condensed_forceout0.dat.npy.json']
+    assert np.array_equal(io_functions.load_forceout(filename), np.loadtxt(filename))
+
+def test_result_cache_returns_what_was_put(tmp_path):
+    forceout = str(tmp_path / 'condensed_forceout0.dat')
+    np.savetxt(forceout, np.column_stack((np.arange(100) * 10.0,
+                                        _correlated_forces(n_frames=100))))
+    cache = cache_functions.ResultCache(str(tmp_path / 'cache'))
+    key = cache.key(forceout, correlation_length=300.0, dstart=10)
+    assert cache.get(key) is None
+
+    facf = _correlated_forces(n_frames=30, seed=1)
+    cache.put(key, mean_force=3.5, facf=facf, facf_integral=12.25,
+            mean_force_sem=0.125, dstep=0.02)
+    entry = cache.get(key)
+    assert entry['mean_force'] == 3.5
+    assert np.array_equal(entry['facf'], facf)
+    assert entry['facf_integral'] == 12.25
+    assert entry['mean_force_sem'] == 0.125
+    assert entry['dstep'] == 0.02
+    assert cache.key(forceout, correlation_length=300.0, dstart=20) != key
+
+def _write_sweep(sweep_dir, n_sims=2, n_windows=6, n_frames=2000):
+    """ Sweep directory with z_windows.out, tracers.out, and forceout files """
+    os.makedirs(sweep_dir)
+    np.savetxt(os.path.join(sweep_dir, 'z_windows.out'),
+                np.linspace(-2, 2, n_windows))
+    for sim_number in range(n_sims):
+        sim_dir = os.path.join(sweep_dir, 'Sim{}'.format(sim_number))
+        os.makedirs(sim_dir)
+        n_tracers = n_windows // n_sims
+        np.savetxt(os.path.join(sim_dir, 'tracers.out'),
+                    np.arange(1, n_tracers + 1), fmt='%d')
+        for i in range(n_tracers):
+            forceout_id = sim_number + i*n_sims
+            forces = _correlated_forces(n_frames=n_frames, seed=forceout_id)
+            np.savetxt(os.path.join(sim_dir,
+                        'condensed_forceout{}.dat'.format(forceout_id)),
+                        np.column_stack((np.arange(n_frames) * 10.0,
+                                        forces + 0.5*forceout_id)))
+
+def test_pipeline_update_matches_full_recompute(tmp_path):
+    sweep_dir = str(tmp_path / 'sweep0')
+    _write_sweep(sweep_dir)
+    pipeline = pipeline_functions.PermeabilityPipeline(sweep_dir, n_sims=2,
+                                        correlation_length=5*u.picosecond)
+    assert pipeline.update() == list(range(6))
+
+    # Extend one window and shift another
+    for filename, shift, n_frames in (('Sim1/condensed_forceout3.dat', 0.7, 1500),
+                                    ('Sim0/condensed_forceout4.dat', -0.2, 2000)):
+        filename = os.path.join(sweep_dir, filename)
+        data = np.loadtxt(filename)[:n_frames]
+        data[:, 1] += shift
+        np.savetxt(filename, data)
+    assert pipeline.update() == [3, 4]
+    assert pipeline.update() == []
+
+    sweep = parallel_functions.analyze_sweeps([sweep_dir], n_sims=2, n_workers=1,
+                                    correlation_length=5*u.picosecond,
+                                    write_outputs=False)[sweep_dir]
+    expected = thermo_functions.permeability_routine(*sweep[:3])
+    for full, patched in zip(expected, pipeline.results()):
+        assert np.allclose(np.asarray(patched._value), np.asarray(full._value),
+                            rtol=1e-10, atol=0)
+    expected = thermo_functions.compute_permeability_error(*sweep)
+    for full, patched in zip(expected, pipeline.errors()):
+        assert np.allclose(np.asarray(patched._value), np.asarray(full._value),
+                            rtol=1e-10, atol=0)
+
+    # A removed window is dropped, like a missing one in analyze_sweeps
+    os.remove(os.path.join(sweep_dir, 'Sim0', 'condensed_forceout2.dat'))
+    assert pipeline.update() == [2]
+    assert pipeline.update() == []
+    sweep = parallel_functions.analyze_sweeps([sweep_dir], n_sims=2, n_workers=1,
+                                    correlation_length=5*u.picosecond,
+                                    write_outputs=False)[sweep_dir]
+    assert np.isnan(sweep[1]._value[2])
+    expected = thermo_functions.permeability_routine(*sweep[:3])
+    results = pipeline.results()
+    assert results[0].shape == (5,)
+    for full, patched in zip(expected, results):
+        assert np.allclose(np.asarray(patched._value), np.asarray(full._value),
+                            rtol=1e-10, atol=0)
+
+def test_chunked_bootstrap_matches_in_memory():
+    rng = np.random.default_rng(3)
+    data = rng.lognormal(size=(8, 5))
+    data[2, 1] = np.nan
+
+    # One chunk: resample all at once with the same child seed
+    single = bootstrap_functions.bootstrap(data, n_bs=2000, log=True, seed=7,
+                                    max_elements=10**9, return_distribution=True)
+    child = np.random.SeedSequence(7).spawn(1)[0]
+    indices = np.random.default_rng(child).integers(0, 8, size=(2000, 8))
+    expected = np.exp(np.nanmean(np.log(data)[indices], axis=1))
+    assert np.allclose(single.distribution, expected, rtol=1e-12)
+
+    # Many chunks: the merged moments and interval are those of the
+    # concatenated distribution, whatever the number of workers
+    for n_workers in (1, 2):
+        chunked = bootstrap_functions.bootstrap(data, n_bs=2000, log=True, seed=7,
+                                        n_workers=n_workers, max_elements=8*5*64,
+                                        return_distribution=True)
+        distribution = chunked.distribution
+        assert distribution.shape == (2000, 5)
+        assert np.allclose(chunked.mean,
+                        np.exp(np.mean(np.log(distribution), axis=0)), rtol=1e-12)
+        assert np.allclose(chunked.std, np.std(distribution, axis=0), rtol=1e-10)
+        assert np.allclose(chunked.ci_low, np.percentile(distribution, 2.5, axis=0))
+        assert np.allclose(chunked.ci_high, np.percentile(distribution, 97.5, axis=0))
+        if n_workers == 1:
+            serial = distribution
+        else:
+            assert np.array_equal(distribution, serial)
+
+def test_headgroup_index_matches_brute_force():
+    pytest.importorskip('scipy')
+    rng = np.random.default_rng(4)
+    box = np.array([5.0, 4.0, 8.0])
+    xyz = rng.uniform(size=(1, 60, 3)) * box
+    xyz[0, :, 2] = np.where(np.arange(60) < 57, 2.0, 6.0) + rng.normal(size=60) * 0.1
+    traj = types.SimpleNamespace(xyz=xyz, unitcell_lengths=box[np.newaxis, :])
+    index = spatial_functions.HeadgroupIndex(traj, np.arange(60))
+    assert [leaflet.shape[0] for leaflet in index.leaflets] == [57, 3]
+
+    # Queries outside the box are wrapped
+    xy = rng.uniform(-1.0, 2.0, size=(7, 2)) * box[:2]
+    neighbors = index.nearest(xy, k=4)
+    for leaflet, found in zip(index.leaflets, neighbors):
+        k = min(4, leaflet.shape[0])
+        assert found.shape == (7, k)
+        delta = xy[:, np.newaxis, :] - xyz[0, leaflet, :2][np.newaxis]
+        delta -= box[:2] * np.round(delta / box[:2])
+        distances = np.hypot(delta[..., 0], delta[..., 1])
+        expected = leaflet[np.argsort(distances, axis=1)[:, :k]]
+        assert np.array_equal(np.sort(found, axis=1), np.sort(expected, axis=1))
+
+def test_grid_surface_given_masses_matches_default():
+    md = pytest.importorskip('mdtraj')
+    pytest.importorskip('bilayer_analysis_functions')
+    topology = md.Topology()
+    residue = topology.add_residue('MOL', topology.add_chain())
+    elements = [md.element.carbon, md.element.oxygen, md.element.hydrogen] * 10
+    for element in elements:
+        topology.add_atom(element.symbol, element, residue)
+    rng = np.random.default_rng(5)
+    traj = md.Trajectory(rng.uniform(size=(4, 30, 3)) * 3.0, topology,
+                        unitcell_lengths=np.full((4, 3), 3.0),
+                        unitcell_angles=np.full((4, 3), 90.0))
+    masses = np.array([element.mass for element in elements])
+
+    default = grid_functions.grid_surface(traj, grid_size=0.5)
+    given = grid_functions.grid_surface(traj, grid_size=0.5, masses=masses)
+    for expected, found in zip(default, given):
+        assert np.allclose(found, expected, rtol=1e-6)
+
+def test_profile_store_round_trip(tmp_path):
+    windows = np.linspace(-2.0, 2.0, 5)
+    units = {'free_energy': 'kilocalorie/mole', 'resistance': 'second/centimeter**2'}
+    store = io_functions.ProfileStore(str(tmp_path), window_coordinates=windows,
+                                    units=units)
+    rng = np.random.default_rng(6)
+    first = {name: rng.normal(size=5) for name in units}
+    second = {name: rng.normal(size=4) for name in units}
+    replaced = {name: rng.normal(size=5) for name in units}
+    assert store.append('sweep0', windows, first).shape == (0,)
+    # Missing the last window, coordinates off by less than the tolerance
+    assert list(store.append('sweep1', windows[:4] + 0.01, second)) == [4]
+    store.append('sweep0', windows, replaced)
+
+    reopened = io_functions.ProfileStore(str(tmp_path))
+    assert reopened.sweeps == ['sweep0', 'sweep1']
+    assert reopened.units == units
+    assert np.array_equal(reopened.window_coordinates, windows)
+    profiles = reopened.load()
+    for name in units:
+        assert np.array_equal(profiles[name][0], replaced[name])
+        assert np.array_equal(profiles[name][1, :4], second[name])
+        assert np.isnan(profiles[name][1, 4])
+
+def test_block_averager_matches_block_average():
+    forces = _correlated_forces(n_frames=3001)
+    expected = uncertainty_functions.block_average(forces)
+    averager = uncertainty_functions.BlockAverager()
+    for chunk in np.array_split(forces, 13):
+        averager.update(chunk)
+    for found, level in zip(averager.result(), expected):
+        assert np.allclose(found, level, rtol=1e-10, atol=0)
+    assert averager.n_frames == 3001
+    sem, converged = averager.sem()
+    expected_sem, expected_converged = uncertainty_functions.optimal_sem(
+                                                *expected, n_frames=3001)
+    assert np.isclose(sem, expected_sem, rtol=1e-10) and converged == expected_converged
+
+    # Pairing by hand at the first level
+    pairs = 0.5 * (forces[:-1:2] + forces[1::2])
+    assert np.isclose(expected[1][1], np.std(pairs) / np.sqrt(pairs.shape[0] - 1),
+                    rtol=1e-10)
+
+def test_window_plateau_matches_force_timeseries(tmp_path):
+    sweep_dir = str(tmp_path / 'sweep0')
+    _write_sweep(sweep_dir, n_frames=5000)
+    sim_dir = os.path.join(sweep_dir, 'Sim1')
+    data = np.loadtxt(os.path.join(sim_dir, 'condensed_forceout3.dat'))
+    times = data[:, 0] * 1e-3 * u.picosecond
+    forces = data[:, 1] * thermo_functions.FORCE_UNIT
+    for plateau_method in ('zero_crossing', 'noise'):
+        mean_force, facf_integral, _ = parallel_functions.analyze_window(sim_dir, 3,
+                                correlation_length=5.0, plateau_method=plateau_method)
+        written = np.loadtxt(os.path.join(sim_dir, 'fcorr3.dat'))
+        assert written.shape[0] == 500
+        # Integrating the written FACF again gives the same integral
+        _, rewritten = thermo_core.integrate_facf_over_time(0.01, written[:, 1],
+                                                        method=plateau_method)
+        assert np.isclose(facf_integral, rewritten, rtol=1e-8)
+
+        # The FACF estimator does not change the integral or its cutoff
+        integrals = []
+        for method in ('fft', 'direct'):
+            _, _, FACF, integral, cutoff = thermo_functions.analyze_force_timeseries(
+                        times, forces, correlation_length=5*u.picosecond,
+                        method=method, plateau_method=plateau_method,
+                        return_integral=True)
+            assert FACF.shape[0] == 500
+            assert np.allclose(written[:, 1], FACF._value, rtol=0,
+                                atol=1e-10 * FACF._value[0])
+            integrals.append((integral.value_in_unit(
+                                thermo_functions.FACF_INTEGRAL_UNIT), cutoff))
+        assert integrals[0][1] == integrals[1][1]
+        assert np.isclose(integrals[0][0], integrals[1][0], rtol=1e-8)
+        assert np.isclose(facf_integral, integrals[0][0], rtol=1e-8)
+        assert np.isclose(mean_force, np.mean(data[:, 1]), rtol=1e-12)
+
+def test_fft_acf_matches_direct():
+    forces = _correlated_forces(n_frames=3000) * thermo_functions.FORCE_UNIT
+    for dstart in (1, 10):
+        direct = thermo_functions.acf(forces, 300, dstart=dstart, method='direct')
+        fft = thermo_functions.acf(forces, 300, dstart=dstart, method='fft')
+        assert fft.unit == direct.unit
+        assert np.allclose(fft._value, direct._value, rtol=0,
+                            atol=1e-10 * direct._value[0])
+
+def test_acf_without_time_origins_raises():
+    forces = _correlated_forces(n_frames=305) * thermo_functions.FORCE_UNIT
+    for method in ('fft', 'direct'):
+        with pytest.raises(Exception, match="Not enough data"):
+            thermo_functions.acf(forces, 300, dstart=10, method=method)
+    with pytest.raises(Exception, match="Not enough data"):
+        thermo_core.batch_acf(np.stack((forces._value, forces._value)),
+                            [305, 300], 295, dstart=10)
+
+def test_force_timeseries_batch_matches_per_window():
+    windows = [_correlated_forces(n_frames=n_frames, seed=seed) * (seed + 1)
+                for seed, n_frames in enumerate((3000, 2200, 2750))]
+    forces, lengths = misc.stack_timeseries(windows)
+    times = np.arange(3000) * 0.01 * u.picosecond
+    mean_forces, time_intervals, FACFs, facf_integrals, sems = (
+            thermo_functions.analyze_force_timeseries_batch(times,
+                        forces * thermo_functions.FORCE_UNIT, lengths=lengths,
+                        correlation_length=2*u.picosecond, return_sem=True))
+    for i, window in enumerate(windows):
+        mean_force, window_times, FACF, facf_integral, _, sem = (
+                thermo_functions.analyze_force_timeseries(
+                        times[:window.shape[0]], window * thermo_functions.FORCE_UNIT,
+                        correlation_length=2*u.picosecond, return_integral=True,
+                        return_sem=True))
+        assert np.allclose(time_intervals._value, window_times._value)
+        assert np.isclose(mean_forces._value[i], mean_force._value, rtol=1e-12)
+        assert np.allclose(FACFs._value[i], FACF._value, rtol=0,
+                            atol=1e-10 * FACF._value[0])
+        assert np.isclose(facf_integrals._value[i], facf_integral._value, rtol=1e-8)
+        assert np.isclose(sems._value[i], sem._value, rtol=1e-8)
+
+def _load_script(name):
+    """ A module from permeability_functions/scripts, which is not a package """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'scripts', name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_absolute_analysis_with_missing_window(tmp_path):
+    absolute_analysis = _load_script('absolute_analysis')
+    sweep_dir = str(tmp_path / 'sweep0')
+    _write_sweep(sweep_dir)
+    os.remove(os.path.join(sweep_dir, 'Sim1', 'condensed_forceout3.dat'))
+    sweep = parallel_functions.analyze_sweeps([sweep_dir], n_sims=2, n_workers=1,
+                                    correlation_length=5*u.picosecond,
+                                    write_outputs=False)[sweep_dir]
+    results = absolute_analysis.analyze_sweep(sweep)
+    assert len(results) == 10
+    assert results[0].shape == (5,)
+
+    keep = np.arange(6) != 3
+    expected = thermo_functions.compute_permeability_error(
+                    sweep[0][keep], sweep[1][keep], sweep[2][keep], sweep[3][keep])
+    assert np.isclose(results[-1]._value, expected[-1]._value, rtol=1e-12)
+    assert results[-1].unit == results[-2].unit
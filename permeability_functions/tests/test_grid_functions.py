@@ -0,0 +1,131 @@
+import types
+
+import numpy as np
+import pytest
+
+import permeability_functions.grid_functions as grid_functions
+
+md = pytest.importorskip('mdtraj')
+
+# Small synthetic bilayers: a headgroup atom per residue in each leaflet,
+# and single-oxygen tracer residues, in a 4 x 4 x 8 nm box
+
+BOX = np.array([4.0, 4.0, 8.0])
+
+def _system(headgroup_xyz, tracer_xyz, headgroup_elements):
+    """ Trajectory with headgroup atoms first, then one atom per tracer,
+    and stubbed topology metadata for it """
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for element in headgroup_elements:
+        residue = topology.add_residue('HG', chain)
+        topology.add_atom(element.symbol, element, residue)
+    for _ in range(tracer_xyz.shape[1]):
+        residue = topology.add_residue('TRC', chain)
+        topology.add_atom('O', md.element.oxygen, residue)
+    n_frames = headgroup_xyz.shape[0]
+    xyz = np.concatenate((headgroup_xyz, tracer_xyz), axis=1)
+    traj = md.Trajectory(xyz, topology, time=np.arange(n_frames) * 10.0,
+                        unitcell_lengths=np.tile(BOX, (n_frames, 1)),
+                        unitcell_angles=np.full((n_frames, 3), 90.0))
+
+    n_headgroups = headgroup_xyz.shape[1]
+    masses = np.array([atom.element.mass for atom in topology.atoms])
+    residue_atoms = np.array([residue.atom(0).index for residue in topology.residues])
+    metadata = types.SimpleNamespace(
+                    headgroup_indices=lambda: np.arange(n_headgroups),
+                    masses=lambda: masses,
+                    residue_atoms=lambda: residue_atoms)
+    return traj, metadata
+
+def _random_system(n_frames=7, n_per_leaflet=40, n_tracers=5, seed=0,
+                    static_xy=False):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(-0.5, 4.5, size=(n_frames, 2*n_per_leaflet, 2))
+    if static_xy:
+        xy[:] = xy[0]
+    z = np.concatenate((np.full(n_per_leaflet, 2.0), np.full(n_per_leaflet, 6.0)))
+    z = z + rng.normal(scale=0.2, size=(n_frames, 2*n_per_leaflet))
+    headgroup_xyz = np.concatenate((xy, z[:, :, np.newaxis]), axis=2)
+    tracer_xyz = rng.uniform(size=(n_frames, n_tracers, 3)) * BOX
+    elements = [md.element.phosphorus, md.element.nitrogen] * n_per_leaflet
+    return _system(headgroup_xyz, tracer_xyz, elements)
+
+def test_fractional_bins():
+    xyz = np.array([[[-0.5, 0.0], [4.0, 1.99], [2.0, 3.99], [8.5, -4.0]]])
+    xbins, ybins = grid_functions._fractional_bins(xyz, BOX[np.newaxis, :2], (2, 4))
+    assert np.array_equal(xbins, [[1, 0, 1, 0]])
+    assert np.array_equal(ybins, [[0, 1, 3, 0]])
+
+def test_cell_mean_heights():
+    xyz = np.array([[[0.5, 0.5, 1.0], [1.5, 1.0, 2.0], [3.0, 3.0, 5.0]]])
+    heights = grid_functions._cell_mean_heights(xyz, BOX[np.newaxis],
+                                        np.array([1.0, 3.0, 2.0]), (2, 2))
+    assert heights.shape == (1, 2, 2)
+    assert np.isclose(heights[0, 0, 0], (1.0 * 1.0 + 3.0 * 2.0) / 4.0)
+    assert np.isclose(heights[0, 1, 1], 5.0)
+    assert np.all(np.isnan(heights[0, [0, 1], [1, 0]]))
+
+def test_interface_grids_matches_cell_loop():
+    traj, metadata = _random_system()
+    headgroups = metadata.headgroup_indices()
+    masses = metadata.masses()
+    bot, top = grid_functions.interface_grids(traj, headgroups, (3, 2),
+                                            masses=masses)
+    leaflets = grid_functions._sort_leaflets(traj, headgroups)
+    for heights, leaflet in zip((bot, top), leaflets):
+        for frame in range(traj.n_frames):
+            xy = np.mod(traj.xyz[frame, leaflet, :2], BOX[:2])
+            xbins = np.minimum((xy[:, 0] / BOX[0] * 3).astype(int), 2)
+            ybins = np.minimum((xy[:, 1] / BOX[1] * 2).astype(int), 1)
+            for i in range(3):
+                for j in range(2):
+                    in_cell = (xbins == i) & (ybins == j)
+                    weights = masses[leaflet][in_cell]
+                    if weights.shape[0] == 0:
+                        assert np.isnan(heights[frame, i, j])
+                        continue
+                    expected = (np.sum(weights * traj.xyz[frame, leaflet, 2][in_cell])
+                                / np.sum(weights))
+                    assert np.isclose(heights[frame, i, j], expected, rtol=1e-6)
+
+@pytest.mark.parametrize('time_resolved', [False, True])
+@pytest.mark.parametrize('n_neighbors', [None, 4])
+def test_distance_from_interface_chunked_matches_whole(time_resolved, n_neighbors):
+    if n_neighbors:
+        pytest.importorskip('scipy')
+    # With n_neighbors, each chunk searches its own first frame, so
+    # headgroups keep their xy for the results to agree
+    traj, metadata = _random_system(static_xy=bool(n_neighbors))
+    tracers = np.arange(80, 85)
+    kwargs = dict(time_resolved=time_resolved, n_neighbors=n_neighbors,
+                grid_size=1.5, topology_metadata=metadata)
+    whole = grid_functions.distance_from_interface(traj, tracers, **kwargs)
+    chunked = grid_functions.distance_from_interface([traj[:3], traj[3:5], traj[5:]],
+                                                    tracers, **kwargs)
+    assert len(whole) == len(chunked)
+    for found, expected in zip(chunked, whole):
+        assert np.allclose(found, expected, rtol=1e-6, equal_nan=True)
+
+def test_distance_from_interface_hand_computed():
+    # One headgroup per 2 x 2 nm cell and leaflet, equal masses
+    cells = np.array([[1.0, 1.0], [3.0, 1.0], [1.0, 3.0], [3.0, 3.0]])
+    bot_z = np.array([2.0, 2.1, 2.2, 2.3])
+    top_z = np.array([6.0, 6.2, 6.4, 6.6])
+    headgroup_xyz = np.concatenate((np.column_stack((cells, bot_z)),
+                                    np.column_stack((cells, top_z))))[np.newaxis]
+    # Above the top leaflet in cell (1, 0), and below the bottom one in cell (0, 1)
+    tracer_xyz = np.array([[[3.2, 0.5, 7.0], [0.4, 3.5, 1.0]]])
+    traj, metadata = _system(headgroup_xyz, tracer_xyz, [md.element.phosphorus] * 8)
+
+    d_local, d_leaflet = grid_functions.distance_from_interface(traj, [8, 9],
+                                    grid_size=2.0, topology_metadata=metadata)
+    assert np.allclose(d_local, [7.0 - 6.2, 2.2 - 1.0], rtol=1e-6)
+    assert np.allclose(d_leaflet, [7.0 - np.mean(top_z), np.mean(bot_z) - 1.0],
+                        rtol=1e-6)
+
+    pytest.importorskip('scipy')
+    d_local, _ = grid_functions.distance_from_interface(traj, 8, grid_size=2.0,
+                                    n_neighbors=2, topology_metadata=metadata)
+    # The two nearest top headgroups, (3, 1) and (3, 3) through the y boundary
+    assert np.isclose(d_local, 7.0 - 0.5 * (6.2 + 6.6), rtol=1e-6)
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+import simtk.unit as u
+
+import permeability_functions.misc as misc
+
+def test_validate_quantity_array():
+    array = np.array([1.0, 2.5, 4.0]) * u.nanometer
+    validated = misc.validate_quantity_type(array, u.angstrom)
+    assert validated.unit == u.angstrom
+    assert np.allclose(validated._value, [10.0, 25.0, 40.0])
+
+def test_validate_quantity_list_mixed_units():
+    array = [1.0*u.nanometer, 5.0*u.angstrom, 2.0*u.nanometer]
+    validated = misc.validate_quantity_type(array, u.nanometer)
+    assert validated.unit == u.nanometer
+    assert np.allclose(validated._value, [1.0, 0.5, 2.0])
+
+    same_unit = [3.0*u.angstrom, 4.0*u.angstrom]
+    assert np.allclose(misc.validate_quantity_type(same_unit, u.nanometer)._value,
+                        [0.3, 0.4])
+
+def test_validate_quantity_nan():
+    array = np.array([1.0, np.nan, 3.0]) * u.nanometer
+    validated, mask = misc.validate_quantity_type(array, u.nanometer,
+                                                return_mask=True)
+    assert np.array_equal(validated._value, [1.0, 3.0])
+    assert np.array_equal(mask, [True, False, True])
+
+    kept, mask = misc.validate_quantity_type(array, u.nanometer,
+                                        return_mask=True, drop_nan=False)
+    assert kept._value.shape == (3,) and np.isnan(kept._value[1])
+    assert np.array_equal(mask, [True, False, True])
+
+def test_validate_quantity_unit_mismatch():
+    with pytest.raises(TypeError):
+        misc.validate_quantity_type(np.ones(3) * u.picosecond, u.nanometer)
+    with pytest.raises(TypeError):
+        misc.validate_quantity_type([1.0*u.nanometer, 1.0*u.picosecond],
+                                    u.nanometer)
+
+def test_align_profiles():
+    windows = np.array([-1.0, -0.5, 0.0, 0.5, 1.0])
+    aligned, missing = misc.align_profiles(windows,
+                        [[-1.02, -0.5, 0.0, 0.51, 1.0], [0.5, -0.49, 0.03]],
+                        [np.arange(5.0), np.array([1.0, 2.0, 3.0])])
+    assert np.array_equal(aligned[0], np.arange(5.0))
+    assert np.array_equal(aligned[1, [1, 2, 3]], [2.0, 3.0, 1.0])
+    assert np.array_equal(missing, [[False] * 5, [True, False, False, False, True]])
+
+    # Trailing dimensions are aligned together
+    aligned, _ = misc.align_profiles(windows, [[1.0, -1.0]],
+                                    [np.array([[1.0, 10.0], [2.0, 20.0]])])
+    assert aligned.shape == (1, 5, 2)
+    assert np.array_equal(aligned[0, 0], [2.0, 20.0])
+    assert np.array_equal(aligned[0, 4], [1.0, 10.0])
+
+def test_align_profiles_raises():
+    windows = np.array([-1.0, 0.0, 1.0])
+    with pytest.raises(ValueError, match="match no window"):
+        misc.align_profiles(windows, [[0.0, 0.5]], [np.ones(2)])
+    with pytest.raises(ValueError, match="Several"):
+        misc.align_profiles(windows, [[0.0, 0.05]], [np.ones(2)])
+
+def _symmetrize_one(data, zero_boundary_condition=False):
+    """ Window by window symmetrization of one profile, for reference """
+    data = np.array(data, dtype=float)
+    n_windows = data.shape[0]
+    shift = 0.0
+    for is_bad in (np.isnan, np.isinf):
+        if is_bad is np.isinf and zero_boundary_condition:
+            # Taken before infinities are filled, as in the original loop
+            shift = data[-1]
+        for i in range(int(np.ceil(n_windows / 2))):
+            if is_bad(data[i]):
+                data[i] = data[-(i+1)]
+            if is_bad(data[-(i+1)]):
+                data[-(i+1)] = data[i]
+    dataSym = np.zeros(n_windows)
+    dataSym_err = np.zeros(n_windows)
+    for i in range(int(np.ceil(n_windows / 2))):
+        dataSym[i] = dataSym[-(i+1)] = 0.5 * (data[i] + data[-(i+1)])
+        dataSym_err[i] = dataSym_err[-(i+1)] = np.std(
+                        [data[i], data[-(i+1)] - shift]) / np.sqrt(2)
+    if zero_boundary_condition:
+        dataSym -= dataSym[0]
+    return dataSym, dataSym_err
+
+def test_symmetrize_matches_per_window():
+    rng = np.random.default_rng(7)
+    for n_windows in (7, 8):
+        profiles = rng.normal(size=(4, n_windows))
+        profiles[0, 1] = np.nan
+        profiles[1, -1] = np.inf
+        profiles[2, 0] = profiles[2, -1] = np.nan
+        for zero_boundary_condition in (False, True):
+            with np.errstate(invalid='ignore'):
+                batch = misc.symmetrize(profiles,
+                                    zero_boundary_condition=zero_boundary_condition)
+            for i, profile in enumerate(profiles):
+                with np.errstate(invalid='ignore'):
+                    expected = _symmetrize_one(profile, zero_boundary_condition)
+                    one = misc.symmetrize(profile,
+                                    zero_boundary_condition=zero_boundary_condition)
+                for found, found_one, value in zip(batch, one, expected):
+                    assert np.allclose(found[i], value, equal_nan=True)
+                    assert np.allclose(found_one, value, equal_nan=True)
+    # The input is left untouched
+    assert np.isnan(profiles[0, 1])
+
+def test_fill_from_mirror():
+    data = np.array([[np.nan, 1.0, 2.0, 3.0], [4.0, np.nan, 5.0, np.nan]])
+    filled = misc._fill_from_mirror(data, np.isnan)
+    assert np.array_equal(filled, [[3.0, 1.0, 2.0, 3.0], [4.0, 5.0, 5.0, 4.0]])
@@ -0,0 +1,279 @@
+import numpy as np
+
+# Unit-free numerical core behind thermo_functions
+# Everything here works on plain float64 np.ndarrays in one canonical unit system
+#   length : angstrom
+#   time : picosecond
+#   energy : kilocalorie/mole
+#   force : kilocalorie/(mole*angstrom)
+# thermo_functions converts to these units once on entry,
+# calls into this module, and attaches units once on exit
+
+KB = 1.987e-3 # kilocalorie/(mole*kelvin)
+TEMP = 305.0 # kelvin
+
+def permeability_routine(reaction_coordinates, mean_forces, facf_integrals,
+                        kbt=KB*TEMP):
+    """ Unit-free version of thermo_functions.permeability_routine
+
+    Params
+    ------
+    reaction_coordinates : np.ndarray, shape=(n,)
+        Window positions in angstrom
+    mean_forces : np.ndarray, shape=(n,)
+        Mean forces in kcal/(mol*angstrom)
+    facf_integrals : np.ndarray, shape=(n,)
+        FACF integrals in (kcal/(mol*angstrom))**2 * ps
+    kbt : float
+        Thermal energy in kcal/mol
+
+    Returns
+    -------
+    fe_profile : kcal/mol
+    diffusion_profile : angstrom**2/ps
+    resistance_profile : ps/angstrom**2
+    resistance_integral : ps/angstrom
+    permeability_profile : angstrom**2/ps
+    permeability_integral : angstrom/ps
+    """
+    fe_profile = compute_free_energy_profile(mean_forces, reaction_coordinates)
+    diffusion_profile = compute_diffusion_coefficient(facf_integrals, kbt=kbt)
+    resistance_profile, resistance_integral = compute_resistance_profile(
+                                                fe_profile, diffusion_profile,
+                                                reaction_coordinates, kbt=kbt)
+    return (fe_profile, diffusion_profile, resistance_profile,
+            resistance_integral, compute_permeability(resistance_profile),
+            compute_permeability(resistance_integral))
+
+def acf(forces, funlen, dstart=10):
+    """ FFT evaluation of the thermo_functions.acf estimator for one timeseries"""
+    lengths = np.array([forces.shape[0]])
+    _, corr = batch_acf(forces[np.newaxis, :], lengths, funlen, dstart=dstart)
+    return corr[0]
+
+def batch_acf(forces, lengths, funlen, dstart=10):
+    """ FFT evaluation of the thermo_functions.acf estimator over many windows
+
+    Params
+    ------
+    forces : np.ndarray, shape=(n_windows, n_frames)
+        Force timeseries, one window per row. Frames past each
+        window's length are ignored (they may be NaN padding)
+    lengths : np.ndarray, shape=(n_windows,)
+        Number of valid frames in each window
+    funlen : int
+        The desired length of the correlation functions
+    dstart : int, default=10
+        Spacing (in frames) between successive time origins
+
+    Returns
+    -------
+    means : np.ndarray, shape=(n_windows,)
+    corr : np.ndarray, shape=(n_windows, funlen)
+
+    Notes
+    -----
+    The subsampled time origins are kept by zeroing every non-origin frame
+    in one copy of the fluctuations, then cross-correlating it against the
+    full fluctuations. Zero-padding to at least n_frames + funlen frames
+    prevents any circular wrap-around within the first funlen lags.
+    Like the direct estimator, raises if a window has fewer than
+    funlen + dstart frames, which leaves no time origin.
+    """
+    lengths = np.asarray(lengths, dtype=int)
+    # At least one time origin with a full funlen of lags after it
+    if np.any((lengths - funlen) // dstart < 1):
+       raise Exception("Not enough data")
+    n_frames = forces.shape[1]
+    frames = np.arange(n_frames)
+    valid = frames[np.newaxis, :] < lengths[:, np.newaxis]
+    means = np.sum(np.where(valid, forces, 0.0), axis=1) / lengths
+    dforces = np.where(valid, forces - means[:, np.newaxis], 0.0)
+
+    # number of time origins
+    ntraj = (lengths - funlen) // dstart
+    is_origin = ((frames % dstart == 0)[np.newaxis, :] &
+                (frames[np.newaxis, :] < (ntraj * dstart)[:, np.newaxis]))
+    origins = np.where(is_origin, dforces, 0.0)
+
+    nfft = _next_pow_two(n_frames + funlen)
+    spectrum = (np.conj(np.fft.rfft(origins, n=nfft, axis=1)) *
+                np.fft.rfft(dforces, n=nfft, axis=1))
+    corr = np.fft.irfft(spectrum, n=nfft, axis=1)[:, :funlen]
+    return means, corr / ntraj[:, np.newaxis]
+
+def _next_pow_two(n):
+    """ Smallest power of two that is >= n """
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+PLATEAU_METHODS = ('fixed', 'zero_crossing', 'noise')
+
+def integrate_facf_over_time(dt, facf, average_fraction=0.1, method='fixed',
+                            return_cutoff=False):
+    """ Unit-free version of thermo_functions.integrate_facf_over_time
+
+    Params
+    ------
+    dt : float
+        Spacing between FACF lags
+    facf : np.ndarray, shape=(..., funlen)
+        FACF, integrated along the last axis
+    average_fraction : float, default=0.1
+        'fixed' averages the cumulative integral over this last fraction
+        of the lags. 'noise' measures the FACF noise over it
+    method : str, default='fixed'
+        How the plateau of the cumulative integral is found, one of
+        'fixed', 'zero_crossing' (the integral up to the first lag where
+        the FACF is no longer positive), or 'noise' (the integral up to 
+        the first lag where the FACF drops below twice its tail noise)
+    return_cutoff : bool, default=False
+        Also return the number of lags the plateau value used
+
+    Returns
+    -------
+    intF : np.ndarray, shape=(..., funlen)
+    intFval : float or np.ndarray, shape=(...)
+    cutoff : np.ndarray of int, shape=(...), only if return_cutoff
+        Always funlen for 'fixed'. For the other methods, funlen means the
+        FACF never met the plateau criterion, the correlation length was
+        too short
+    """
+    intF = np.cumsum(facf, axis=-1) * dt
+    funlen = intF.shape[-1]
+    lastbit = max(1, int(average_fraction*funlen))
+    if method == 'fixed':
+        intFval = np.mean(intF[..., -lastbit:], axis=-1)
+        cutoff = np.full(intF.shape[:-1], funlen, dtype=int)
+    elif method in ('zero_crossing', 'noise'):
+        threshold = 0.0
+        if method == 'noise':
+            threshold = 2 * np.std(facf[..., -lastbit:], axis=-1, keepdims=True)
+        below = facf <= threshold
+        # Lags before the first one at or below the threshold, funlen if none
+        cutoff = np.where(np.any(below, axis=-1), np.argmax(below, axis=-1), 
+                            funlen)
+        last = np.maximum(cutoff, 1) - 1
+        intFval = np.take_along_axis(intF, last[..., np.newaxis], axis=-1)[..., 0]
+    else:
+        raise ValueError("Unknown plateau method '{}'".format(method))
+    # Scalars, not 0-d arrays, for a single FACF
+    intFval, cutoff = intFval[()], cutoff[()]
+    if return_cutoff:
+        return intF, intFval, cutoff
+    return intF, intFval
+
+def compute_free_energy_profile(forces, reaction_coordinates):
+    """ Negative cumulative trapezoid integral of the mean forces, kcal/mol"""
+    segments = (0.5 * (forces[1:] + forces[:-1]) *
+                np.diff(reaction_coordinates))
+    return -np.concatenate(([0.0], np.cumsum(segments)))
+
+def compute_diffusion_coefficient(intfacf, kbt=KB*TEMP):
+    """ Diffusion coefficient from FACF integrals, angstrom**2/ps"""
+    return kbt**2 / intfacf
+
+def compute_resistance_profile(fe_profile, diff_profile, reaction_coordinates,
+                                kbt=KB*TEMP):
+    """ Resistance integrand (ps/angstrom**2) and its integral (ps/angstrom)"""
+    integrand = np.exp(fe_profile/kbt) / diff_profile
+    return integrand, _trapz(integrand, reaction_coordinates)
+
+def compute_permeability(resistance):
+    return 1/resistance
+
+def _trapz(y, x):
+    """ Trapezoid integral of y over x """
+    return np.sum(0.5 * (y[1:] + y[:-1]) * np.diff(x))
+
+class StreamingACF(object):
+    """ Accumulate the mean and the `acf` estimator over chunks of a timeseries
+
+    Params
+    ------
+    funlen : int
+        The desired length of the correlation function
+    dstart : int, default=10
+        Spacing (in frames) between successive time origins
+
+    Notes
+    -----
+    Feed consecutive chunks with `update`, then call `result`, which gives
+    the same mean and correlation as `batch_acf` on the whole timeseries.
+    The estimator subtracts the global mean, which is unknown until the
+    last chunk, so raw sums over origins are accumulated instead and 
+    combined with the final mean. Values are shifted by the first chunk's 
+    mean to avoid cancellation in those sums.
+    Time origin k is only committed once frame k*dstart + funlen + dstart 
+    has been seen, which is exactly the condition for it to be among the
+    floor((n - funlen)/dstart) origins of the full timeseries.
+    Only the frames still needed by uncommitted origins are buffered 
+    (overlap-save), so memory is bounded by the chunk size plus funlen.
+    """
+    def __init__(self, funlen, dstart=10):
+        self.funlen = funlen
+        self.dstart = dstart
+        self.n_frames = 0
+        self._shift = None
+        self._sum = 0.0
+        self._buffer = np.zeros(0)
+        self._buffer_start = 0
+        self._next_origin = 0
+        self._n_origins = 0
+        self._sum_origins = 0.0
+        self._sum_lagged = np.zeros(funlen)
+        self._sum_products = np.zeros(funlen)
+
+    def update(self, forces):
+        """ Add the next chunk of the timeseries """
+        forces = np.asarray(forces, dtype=float)
+        if forces.size == 0:
+            return
+        if self._shift is None:
+            self._shift = np.mean(forces)
+        shifted = forces - self._shift
+        self._sum += np.sum(shifted)
+        self.n_frames += shifted.shape[0]
+        self._buffer = np.concatenate((self._buffer, shifted))
+
+        last_origin = self.n_frames - self.funlen - self.dstart
+        if last_origin >= self._next_origin:
+            origins = np.arange(self._next_origin, last_origin + 1, self.dstart)
+            self._accumulate(origins - self._buffer_start)
+            self._n_origins += origins.shape[0]
+            self._next_origin = origins[-1] + self.dstart
+
+        drop = self._next_origin - self._buffer_start
+        self._buffer = self._buffer[drop:]
+        self._buffer_start = self._next_origin
+
+    def _accumulate(self, local_origins):
+        """ Add raw origin sums for origins given as buffer indices """
+        segment = self._buffer[local_origins[0]:local_origins[-1] + self.funlen]
+        local_origins = local_origins - local_origins[0]
+        origin_values = np.zeros_like(segment)
+        origin_values[local_origins] = segment[local_origins]
+        indicator = np.zeros_like(segment)
+        indicator[local_origins] = 1.0
+
+        nfft = _next_pow_two(segment.shape[0] + self.funlen)
+        segment_spectrum = np.fft.rfft(segment, n=nfft)
+        self._sum_products += np.fft.irfft(np.conj(np.fft.rfft(origin_values, 
+                        n=nfft)) * segment_spectrum, n=nfft)[:self.funlen]
+        self._sum_lagged += np.fft.irfft(np.conj(np.fft.rfft(indicator, 
+                        n=nfft)) * segment_spectrum, n=nfft)[:self.funlen]
+        self._sum_origins += np.sum(origin_values)
+
+    def result(self):
+        """ Mean and autocorrelation of everything seen so far
+
+        Returns
+        -------
+        mean : float
+        corr : np.ndarray, shape=(funlen,)
+        """
+        if self._n_origins == 0:
+            raise Exception("Not enough data")
+        mean = self._sum / self.n_frames
+        corr = (self._sum_products - mean * self._sum_lagged 
+                - mean * self._sum_origins + self._n_origins * mean**2)
+        return mean + self._shift, corr / self._n_origins
@@ -1,9 +1,11 @@
-import scipy.integrate
 import numpy as np
 
 import simtk.unit as u
 
 import permeability_functions.misc as misc
+import permeability_functions.io_functions as io_functions
+import permeability_functions.thermo_core as thermo_core
+import permeability_functions.uncertainty_functions as uncertainty_functions
 
 # 1) Compute means and force autocorrelations
 # 2) Integrate force correlations over time and get diffusion
@@ -11,43 +13,76 @@ import permeability_functions.misc as misc
 # 4) Use inhomogeneous-diffusion solubility model to get resistance over distance
 # 5) Invert resistance to get permeability
 
-def permeability_routine(reaction_coordinates, mean_forces, facf_integrals):
+# The arithmetic lives in thermo_core, which works on plain floats in 
+# these canonical units. Functions here convert Quantities to these units
+# on entry and attach units to the results on exit
+LENGTH_UNIT = u.angstrom
+TIME_UNIT = u.picosecond
+ENERGY_UNIT = u.kilocalorie/u.mole
+FORCE_UNIT = ENERGY_UNIT/LENGTH_UNIT
+FACF_INTEGRAL_UNIT = FORCE_UNIT**2*TIME_UNIT
+DIFFUSION_UNIT = LENGTH_UNIT**2/TIME_UNIT
+
+def permeability_routine(reaction_coordinates, mean_forces, facf_integrals,
+                        kb=1.987e-3 * u.kilocalorie / (u.mole * u.kelvin),
+                        temp=305*u.kelvin):
     """ Umbrella function that calls functions to look at free energy,
     diffusion, resistance, and permeability """
-    reaction_coordinates = misc.validate_quantity_type(reaction_coordinates, 
-                                                        u.nanometer)
-    mean_forces = misc.validate_quantity_type(mean_forces, 
-                                            u.kilocalorie/(u.mole*u.angstrom))
-
-    facf_integrals = misc.validate_quantity_type(facf_integrals, 
-                                (u.kilocalorie/(u.mole*u.angstrom))**2*u.picosecond)
+    reaction_coordinates, rc_mask = misc.validate_quantity_type(
+                                        reaction_coordinates, u.nanometer,
+                                        return_mask=True, drop_nan=False)
+    mean_forces, force_mask = misc.validate_quantity_type(mean_forces, 
+                                        FORCE_UNIT,
+                                        return_mask=True, drop_nan=False)
+    facf_integrals, facf_mask = misc.validate_quantity_type(facf_integrals, 
+                                        FACF_INTEGRAL_UNIT,
+                                        return_mask=True, drop_nan=False)
 
-    fe_profile = compute_free_energy_profile(mean_forces,
-                                                            reaction_coordinates)
+    # Drop a window from every array if any of its values are missing
+    mask = rc_mask & force_mask & facf_mask
+    reaction_coordinates = reaction_coordinates[mask]
+    mean_forces = mean_forces[mask]
+    facf_integrals = facf_integrals[mask]
 
-    diffusion_profile = compute_diffusion_coefficient(
-                                                            facf_integrals)
+    (fe_profile, diffusion_profile, resistance_profile, resistance_integral,
+        permeability_profile, permeability_integral) = thermo_core.permeability_routine(
+                        reaction_coordinates.value_in_unit(LENGTH_UNIT),
+                        mean_forces._value, facf_integrals._value,
+                        kbt=(kb*temp).value_in_unit(ENERGY_UNIT))
 
-    resistance_profile, resistance_integral = compute_resistance_profile(
-                                                    fe_profile, 
-                                                    diffusion_profile, 
-                                                    reaction_coordinates)
-    permeability_profile = compute_permeability(resistance_profile)
-    permeability_profile = permeability_profile.in_units_of(u.centimeter**2/u.second)
-
-    permeability_integral = compute_permeability(resistance_integral)
-    permeability_integral = permeability_integral.in_units_of(u.centimeter/u.second)
+    fe_profile = fe_profile * ENERGY_UNIT
+    diffusion_profile = (diffusion_profile * DIFFUSION_UNIT).in_units_of(
+                                                    u.centimeter**2/u.second)
+    resistance_profile = (resistance_profile / DIFFUSION_UNIT).in_units_of(
+                                                    u.second/u.centimeter**2)
+    resistance_integral = (resistance_integral * TIME_UNIT/LENGTH_UNIT).in_units_of(
+                                                    u.second/u.centimeter)
+    permeability_profile = (permeability_profile * DIFFUSION_UNIT).in_units_of(
+                                                    u.centimeter**2/u.second)
+    permeability_integral = (permeability_integral * LENGTH_UNIT/TIME_UNIT).in_units_of(
+                                                    u.centimeter/u.second)
 
     return (reaction_coordinates, mean_forces, facf_integrals, fe_profile, diffusion_profile, resistance_profile, resistance_integral, permeability_profile, permeability_integral)
 
 def analyze_force_timeseries(times, forces, meanf_name=None, fcorr_name=None,
-                            correlation_length=300*u.picosecond):
-    """ Given a timeseries of forces, compute force autocorrealtions and means"""
+                            correlation_length=300*u.picosecond, method='fft',
+                            return_sem=False, plateau_method='fixed',
+                            average_fraction=0.1, return_integral=False):
+    """ Given a timeseries of forces, compute force autocorrealtions and means
+
+    The `method` is passed through to `acf`. If return_integral, the FACF
+    integral and the lag time it was taken up to are also returned, from
+    `integrate_facf_over_time` with average_fraction and plateau_method.
+    The plateau is found once, on the FACF of the full correlation_length,
+    so the integral does not depend on `method`, and integrating the
+    written FACF again gives the same value. If return_sem, the standard 
+    error of the mean force is returned last, from the statistical 
+    inefficiency of the FACF (see `uncertainty_functions.mean_force_sem`)"""
     mean_force = np.mean(forces)
     times = misc.validate_quantity_type(times, u.picosecond)
     dstep = times[1] - times[0]
     funlen = int(correlation_length/dstep)
-    FACF = acf(forces, funlen, dstart=10)
+    FACF = acf(forces, funlen, dstart=10, method=method)
     time_intervals = np.arange(0, funlen*dstep._value, dstep._value )*dstep.unit
     time_intevals = misc.validate_quantity_type(time_intervals, dstep.unit)
     times_facf = np.column_stack((time_intervals, FACF))
@@ -56,9 +91,151 @@ def analyze_force_timeseries(times, forces, meanf_name=None, fcorr_name=None,
     if meanf_name:
         np.savetxt(meanf_name, [mean_force._value])
 
+    results = (mean_force, time_intervals, FACF)
+    if return_integral:
+        _, facf_integral, cutoff = integrate_facf_over_time(time_intervals, FACF,
+                                        average_fraction=average_fraction,
+                                        method=plateau_method, return_cutoff=True)
+        results += (facf_integral, cutoff)
+    if return_sem:
+        results += (_mean_force_sem(FACF, forces.shape[0]),)
+    return results
+
+def _mean_force_sem(FACF, n_frames):
+    """ uncertainty_functions.mean_force_sem, for a FACF with or without units """
+    if isinstance(FACF, u.Quantity):
+        return uncertainty_functions.mean_force_sem(FACF._value, n_frames) * (
+                                                                FACF.unit**0.5)
+    return uncertainty_functions.mean_force_sem(FACF, n_frames)
+
+def analyze_forceout_file(filename, usecols=(0, 1), time_unit=u.femtosecond,
+                        force_unit=FORCE_UNIT, meanf_name=None, fcorr_name=None,
+                        correlation_length=300*u.picosecond, dstart=10,
+                        chunk_size=100000, return_sem=False):
+    """ Streaming equivalent of loading a forceout file and calling 
+    analyze_force_timeseries
+
+    Params
+    ------
+    filename : str
+    usecols : tuple of int, default=(0, 1)
+        (time, force) columns, (0, 1) for condensed_forceout files
+        and (1, 2) for raw forceout files
+    time_unit, force_unit : simtk.Unit
+        Units of the time and force columns
+    chunk_size : int, default=100000
+        Number of lines parsed and correlated at once
+    return_sem : bool, default=False
+
+    Returns
+    -------
+    mean_force, time_intervals, FACF, (mean_force_sem) as in 
+    analyze_force_timeseries
+
+    Notes
+    -----
+    The file is never held in memory at once, memory is bounded by
+    chunk_size and the correlation length regardless of trajectory length
+    """
+    accumulator = None
+    for chunk in io_functions.iter_forceout_chunks(filename, usecols=usecols,
+                                                    chunk_size=chunk_size):
+        if accumulator is None:
+            dstep = ((chunk[1, 0] - chunk[0, 0]) * time_unit).in_units_of(TIME_UNIT)
+            funlen = int(correlation_length/dstep)
+            accumulator = thermo_core.StreamingACF(funlen, dstart=dstart)
+        accumulator.update(chunk[:, 1])
+    if accumulator is None:
+        raise Exception("Not enough data")
+    mean_force, FACF = accumulator.result()
+
+    time_intervals = np.arange(0, funlen*dstep._value, dstep._value )*dstep.unit
+    mean_force = mean_force * force_unit
+    FACF = FACF * force_unit**2
+    if fcorr_name:
+        np.savetxt(fcorr_name, np.column_stack((time_intervals._value, FACF._value)))
+    if meanf_name:
+        np.savetxt(meanf_name, [mean_force._value])
+
+    if return_sem:
+        return mean_force, time_intervals, FACF, _mean_force_sem(FACF,
+                                                    accumulator.n_frames)
     return mean_force, time_intervals, FACF
 
-def acf(forces, funlen, dstart=10):
+def analyze_force_timeseries_batch(times, forces, lengths=None, 
+                            meanf_names=None, fcorr_names=None,
+                            correlation_length=300*u.picosecond, dstart=10,
+                            average_fraction=0.1, plateau_method='fixed',
+                            return_sem=False):
+    """ Compute mean forces, FACFs, and FACF integrals for many windows at once
+
+    Params
+    ------
+    times : u.Quantity, shape=(n_frames,)
+        Times of the frames, the timestep is shared by all windows
+    forces : u.Quantity, shape=(n_windows, n_frames)
+        Force timeseries, one window per row. Ragged windows are padded
+        at the end, see `misc.stack_timeseries`
+    lengths : array-like of int, shape=(n_windows,), optional
+        Number of valid frames in each window. If None, every non-NaN
+        frame is counted, so padding must be NaN
+    meanf_names, fcorr_names : list of str, optional
+        Per-window filenames, written like `analyze_force_timeseries`
+    correlation_length : u.Quantity
+    dstart : int, default=10
+        Spacing (in frames) between successive time origins
+    average_fraction : float, default=0.1
+    plateau_method : str, default='fixed'
+        average_fraction and plateau_method are passed to 
+        `integrate_facf_over_time`
+    return_sem : bool, default=False
+
+    Returns
+    -------
+    mean_forces : u.Quantity, shape=(n_windows,)
+    time_intervals : u.Quantity, shape=(funlen,)
+    FACFs : u.Quantity, shape=(n_windows, funlen)
+    facf_integrals : u.Quantity, shape=(n_windows,)
+    mean_force_sems : u.Quantity, shape=(n_windows,), only if return_sem
+        From each window's FACF and number of frames,
+        see `uncertainty_functions.mean_force_sem`
+
+    Notes
+    -----
+    Each row gives the same results as `analyze_force_timeseries` followed
+    by `integrate_facf_over_time`, but all windows share a single FFT
+    """
+    force_unit = forces.unit
+    forces = np.atleast_2d(np.asarray(forces._value, dtype=float))
+    if lengths is None:
+        lengths = np.sum(~np.isnan(forces), axis=1)
+    times = misc.validate_quantity_type(times, u.picosecond)
+    dstep = times[1] - times[0]
+    funlen = int(correlation_length/dstep)
+
+    means, corr = thermo_core.batch_acf(forces, lengths, funlen, dstart=dstart)
+    mean_forces = means * force_unit
+    FACFs = corr * force_unit**2
+    time_intervals = np.arange(0, funlen*dstep._value, dstep._value )*dstep.unit
+    _, facf_integrals = thermo_core.integrate_facf_over_time(dstep._value, corr,
+                                        average_fraction=average_fraction,
+                                        method=plateau_method)
+    facf_integrals = facf_integrals * force_unit**2 * dstep.unit
+
+    if fcorr_names:
+        for fcorr_name, facf in zip(fcorr_names, corr):
+            np.savetxt(fcorr_name, np.column_stack((time_intervals._value, facf)))
+    if meanf_names:
+        for meanf_name, mean_force in zip(meanf_names, means):
+            np.savetxt(meanf_name, [mean_force])
+
+    if return_sem:
+        mean_force_sems = uncertainty_functions.mean_force_sem(corr, 
+                                            lengths) * force_unit
+        return mean_forces, time_intervals, FACFs, facf_integrals, mean_force_sems
+    return mean_forces, time_intervals, FACFs, facf_integrals
+
+def acf(forces, funlen, dstart=10, method='fft'):
     """Calculate the autocorrelation of a function
 
     Params
@@ -69,14 +246,35 @@ def acf(forces, funlen, dstart=10):
         Simulation timestep in fs
     funlen : int
         The desired length of the correlation function
+    dstart : int, default=10
+        Spacing (in frames) between successive time origins
+    method : str, default='fft'
+        'direct' walks the time origins in a loop, 'fft' evaluates the
+        same estimator through a zero-padded Wiener-Khinchin correlation
 
     Returns
     -------
     corr : np.array, shape=(funlen,)
         The autocorrelation of the forces
+
+    Notes
+    -----
+    Both methods average dF(origin)*dF(origin+lag) over the same
+    time origins (0, dstart, 2*dstart, ...), so they compute the same 
+    estimator. The 'fft' result agrees with 'direct' to floating point 
+    roundoff, in practice within 1e-10 relative to corr[0]. 
+    Use dstart=1 to include every available time origin.
     """    
-    if funlen > forces.shape[0]:
+    if (forces.shape[0] - funlen) // dstart < 1:
        raise Exception("Not enough data")
+    if method == 'fft':
+        if isinstance(forces, u.Quantity):
+            return thermo_core.acf(np.asarray(forces._value, dtype=float), 
+                                funlen, dstart=dstart) * forces.unit**2
+        return thermo_core.acf(np.asarray(forces, dtype=float), funlen, 
+                                dstart=dstart)
+    elif method != 'direct':
+        raise ValueError("Unknown acf method '{}'".format(method))
     # number of time origins
     ntraj = int(np.floor((forces.shape[0]-funlen)/dstart))
     meanfz = np.mean(forces)
@@ -89,20 +287,39 @@ def acf(forces, funlen, dstart=10):
         origin += dstart
     return f1/ntraj
 
-
-def integrate_facf_over_time(times, facf, average_fraction=0.1):
+def integrate_facf_over_time(times, facf, average_fraction=0.1, method='fixed',
+                            return_cutoff=False):
     """ Integrate force autocorelations
 
+    Params
+    ------
+    times : u.Quantity
+        Lag times of the FACF
+    facf : u.Quantity, shape=(funlen,) or (n_windows, funlen)
+    average_fraction : float, default=0.1
+    method : str, default='fixed'
+        'fixed', 'zero_crossing', or 'noise', see thermo_core.integrate_facf_over_time
+    return_cutoff : bool, default=False
+        Also return the lag time up to which the FACF was integrated
+
     Notes
     -----
-    We're doing a cumulative sum, but average the 'last bit' in order 
-    to average out the noise
+    We're doing a cumulative sum, and take its plateau as the integral.
+    'fixed' averages the 'last bit' (the last average_fraction of the lags)
+    in order to average out the noise, the other methods stop where
+    the FACF has decayed.
+    A 2D facf of shape (n_windows, funlen) is integrated row by row
     """
-    intF = np.cumsum(facf)*facf.unit * (times[1]-times[0])
-    lastbit = int((1.0-average_fraction)*intF.shape[0])
-    intFval = np.mean(intF[-lastbit:])
+    dt = times[1] - times[0]
+    intF, intFval, cutoff = thermo_core.integrate_facf_over_time(dt._value,
+                                np.asarray(facf._value, dtype=float),
+                                average_fraction=average_fraction,
+                                method=method, return_cutoff=True)
+    unit = facf.unit * dt.unit
 
-    return intF, intFval
+    if return_cutoff:
+        return intF*unit, intFval*unit, cutoff*dt
+    return intF*unit, intFval*unit
 
 def compute_free_energy_profile(forces, reaction_coordinates):
     """
@@ -113,34 +330,129 @@ def compute_free_energy_profile(forces, reaction_coordinates):
     -----
     Forces and reaction_coordinates are u.Quantity, but the elements should just be floats
     """
-    forces = misc.validate_quantity_type(forces, (u.kilocalorie / (u.mole * u.angstrom)))
-    reaction_coordinates = misc.validate_quantity_type(reaction_coordinates, u.angstrom)
+    forces = misc.validate_quantity_type(forces, FORCE_UNIT)
+    reaction_coordinates = misc.validate_quantity_type(reaction_coordinates, 
+                                                        LENGTH_UNIT)
+
+    return thermo_core.compute_free_energy_profile(forces._value, 
+                                reaction_coordinates._value) * ENERGY_UNIT
+
+def compute_free_energy_error(force_errors, reaction_coordinates):
+    """ Uncertainty of compute_free_energy_profile from the mean force errors
+
+    force_errors : array of floats, u.Quantity
+        Standard errors of the mean forces
+    reaction_coordinates: array of floats, u.Quantity
+
+    Notes
+    -----
+    See uncertainty_functions.propagate_free_energy_error
+    """
+    force_errors = misc.validate_quantity_type(force_errors, FORCE_UNIT)
+    reaction_coordinates = misc.validate_quantity_type(reaction_coordinates,
+                                                        LENGTH_UNIT)
 
-    return -scipy.integrate.cumtrapz(forces._value, x=reaction_coordinates._value, initial=0)*forces.unit*reaction_coordinates.unit
+    return uncertainty_functions.propagate_free_energy_error(
+                                force_errors.value_in_unit(FORCE_UNIT),
+                                reaction_coordinates.value_in_unit(LENGTH_UNIT)
+                                ) * ENERGY_UNIT
 
 def compute_diffusion_coefficient(intfacf, 
                                 kb=1.987e-3 * u.kilocalorie / (u.mole * u.kelvin),
                                 temp=305*u.kelvin):
-    intfacf = misc.validate_quantity_type(intfacf, (u.kilocalorie / (u.mole * u.angstrom))**2 * u.picosecond)
+    intfacf = misc.validate_quantity_type(intfacf, FACF_INTEGRAL_UNIT)
     
+    diffusion_coefficient = thermo_core.compute_diffusion_coefficient(
+                        intfacf._value, kbt=(kb*temp).value_in_unit(ENERGY_UNIT))
 
-    RT2 = (kb*temp)**2
-    diffusion_coefficient = (RT2/intfacf).in_units_of(u.centimeter**2/u.second)
-
-    return diffusion_coefficient
+    return (diffusion_coefficient*DIFFUSION_UNIT).in_units_of(u.centimeter**2/u.second)
 
 def compute_resistance_profile(fe_profile, diff_profile, reaction_coordinates,
                                 kb=1.987e-3 * u.kilocalorie / (u.mole * u.kelvin),
                                 temp=305*u.kelvin):
-    fe_profile = misc.validate_quantity_type(fe_profile, u.kilocalorie/u.mole)
+    fe_profile = misc.validate_quantity_type(fe_profile, ENERGY_UNIT)
     
-    diff_profile = misc.validate_quantity_type(diff_profile, u.centimeter**2/u.second)
+    diff_profile = misc.validate_quantity_type(diff_profile, DIFFUSION_UNIT)
+    reaction_coordinates = misc.validate_quantity_type(reaction_coordinates,
+                                                        LENGTH_UNIT)
     
-    numerator = np.exp(fe_profile/(kb*temp))
-    integrand = numerator/diff_profile
-    return integrand, scipy.integrate.trapz(integrand, x=reaction_coordinates) * reaction_coordinates.unit/diff_profile.unit
+    integrand, integral = thermo_core.compute_resistance_profile(
+                        fe_profile._value, diff_profile._value, 
+                        reaction_coordinates._value, 
+                        kbt=(kb*temp).value_in_unit(ENERGY_UNIT))
+    integrand = (integrand / DIFFUSION_UNIT).in_units_of(u.second/u.centimeter**2)
+    integral = (integral * TIME_UNIT/LENGTH_UNIT).in_units_of(u.second/u.centimeter)
+    return integrand, integral
 
-def compute_permeability(resistance):
-    return 1/resistance
+def compute_permeability_error(reaction_coordinates, mean_forces, 
+                                facf_integrals, force_errors,
+                                facf_integral_errors=None,
+                                kb=1.987e-3 * u.kilocalorie / (u.mole * u.kelvin),
+                                temp=305*u.kelvin):
+    """ Uncertainties of the profiles of permeability_routine
+
+    Params
+    ------
+    reaction_coordinates, mean_forces, facf_integrals : u.Quantity
+        As in permeability_routine
+    force_errors : u.Quantity
+        Standard errors of the mean forces, e.g. the window_force_errors
+        of parallel_functions.analyze_sweeps
+    facf_integral_errors : u.Quantity, optional
+        Standard errors of the FACF integrals, taken as 0 by default
+
+    Returns
+    -------
+    fe_errors : u.Quantity, kcal/mol
+    resistance_errors : u.Quantity, s/cm**2
+    resistance_integral_error : u.Quantity, s/cm
+    permeability_integral_error : u.Quantity, cm/s
 
+    Notes
+    -----
+    Windows are dropped like in permeability_routine, if any of their
+    values (or errors) are missing.
+    See uncertainty_functions.propagate_permeability_error
+    """
+    reaction_coordinates, rc_mask = misc.validate_quantity_type(
+                                        reaction_coordinates, LENGTH_UNIT,
+                                        return_mask=True, drop_nan=False)
+    mean_forces, force_mask = misc.validate_quantity_type(mean_forces, 
+                                        FORCE_UNIT,
+                                        return_mask=True, drop_nan=False)
+    facf_integrals, facf_mask = misc.validate_quantity_type(facf_integrals, 
+                                        FACF_INTEGRAL_UNIT,
+                                        return_mask=True, drop_nan=False)
+    force_errors, error_mask = misc.validate_quantity_type(force_errors,
+                                        FORCE_UNIT,
+                                        return_mask=True, drop_nan=False)
+    mask = rc_mask & force_mask & facf_mask & error_mask
+    if facf_integral_errors is not None:
+        facf_integral_errors, facf_error_mask = misc.validate_quantity_type(
+                                        facf_integral_errors, FACF_INTEGRAL_UNIT,
+                                        return_mask=True, drop_nan=False)
+        mask &= facf_error_mask
+        facf_integral_errors = facf_integral_errors.value_in_unit(
+                                        FACF_INTEGRAL_UNIT)[mask]
 
+    (fe_errors, resistance_errors, resistance_integral_error,
+        permeability_integral_error) = uncertainty_functions.propagate_permeability_error(
+                        reaction_coordinates.value_in_unit(LENGTH_UNIT)[mask],
+                        mean_forces.value_in_unit(FORCE_UNIT)[mask],
+                        facf_integrals.value_in_unit(FACF_INTEGRAL_UNIT)[mask],
+                        force_errors.value_in_unit(FORCE_UNIT)[mask],
+                        facf_integral_errors=facf_integral_errors,
+                        kbt=(kb*temp).value_in_unit(ENERGY_UNIT))
+
+    fe_errors = fe_errors * ENERGY_UNIT
+    resistance_errors = (resistance_errors / DIFFUSION_UNIT).in_units_of(
+                                                    u.second/u.centimeter**2)
+    resistance_integral_error = (resistance_integral_error * TIME_UNIT/LENGTH_UNIT
+                                ).in_units_of(u.second/u.centimeter)
+    permeability_integral_error = (permeability_integral_error * LENGTH_UNIT/TIME_UNIT
+                                ).in_units_of(u.centimeter/u.second)
+    return (fe_errors, resistance_errors, resistance_integral_error,
+            permeability_integral_error)
+
+def compute_permeability(resistance):
+    return 1/resistance
@@ -0,0 +1,114 @@
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+# Per-system cache of static topology facts
+# Masses, residue atoms, water and headgroup indices, and atom selections
+# only depend on a system's topology, which is shared by every Sim of every
+# sweep. They are computed once and kept in one small .npz file per system,
+# keyed on the .gro file's topology columns (residue and atom names), so
+# .gro files that differ only in coordinates or box share an entry
+
+# Bump when the stored fields change
+CACHE_VERSION = 1
+
+class TopologyMetadata(object):
+    """ Cached topology metadata of one system
+
+    Parameters
+    ---------
+    grofile : str
+    cache_dir : str, optional
+        Where entries are stored, by default next to grofile. Pass one
+        directory for all Sims and sweeps so they share entries
+
+    Notes
+    -----
+    Each field is computed the first time it is asked for, by loading
+    grofile with mdtraj, and then stored. Entries are written atomically,
+    so concurrent processes can share a cache; a process that loses a
+    race only loses the fields it added, which are recomputed next time
+    """
+    def __init__(self, grofile, cache_dir=None):
+        self.grofile = grofile
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(grofile))
+        self.directory = os.path.abspath(cache_dir)
+        self.key = topology_sha1(grofile)
+        self.path = os.path.join(self.directory,
+                        'topology_{0}_v{1}.npz'.format(self.key, CACHE_VERSION))
+        self._arrays = self._load()
+        self._traj = None
+
+    def _load(self):
+        """ Stored fields, nothing if the entry is missing or unreadable """
+        try:
+            with np.load(self.path) as entry:
+                return {name: entry[name] for name in entry.files}
+        except Exception:
+            return {}
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                        delete=False) as f:
+            np.savez(f, **self._arrays)
+        os.replace(f.name, self.path)
+
+    def _get(self, name, compute):
+        if name not in self._arrays:
+            self._arrays[name] = np.asarray(compute())
+            self._save()
+        return self._arrays[name]
+
+    @property
+    def traj(self):
+        """ grofile loaded with mdtraj, only on a cache miss """
+        if self._traj is None:
+            import mdtraj
+            self._traj = mdtraj.load(self.grofile)
+        return self._traj
+
+    def masses(self):
+        """ Mass of every atom, in amu """
+        return self._get('masses', lambda: [atom.element.mass
+                                    for atom in self.traj.topology.atoms])
+
+    def residue_atoms(self):
+        """ Index of the first atom of every residue, e.g. a tracer's oxygen """
+        return self._get('residue_atoms', lambda: [residue.atom(0).index
+                                    for residue in self.traj.topology.residues])
+
+    def water_residues(self):
+        """ Boolean mask of water residues """
+        return self._get('water_residues', lambda: np.array([residue.is_water
+                        for residue in self.traj.topology.residues], dtype=bool))
+
+    def water_indices(self):
+        return self.select('water')
+
+    def headgroup_indices(self):
+        """ Lipid headgroup atoms, as chosen by grid_analysis """
+        def compute():
+            import grid_analysis
+            return np.asarray(grid_analysis._get_headgroup_indices(self.traj),
+                            dtype=int)
+        return self._get('headgroup_indices', compute)
+
+    def select(self, selection):
+        """ Atom indices of an mdtraj selection string """
+        return self._get('select:' + selection,
+                        lambda: self.traj.topology.select(selection))
+
+def topology_sha1(grofile):
+    """ sha1 of the residue and atom name/number columns of a .gro file """
+    digest = hashlib.sha1()
+    with open(grofile) as f:
+        f.readline()
+        n_atoms = int(f.readline())
+        digest.update(str(n_atoms).encode())
+        for _ in range(n_atoms):
+            digest.update(f.readline()[:20].encode())
+    return digest.hexdigest()
@@ -0,0 +1,289 @@
+import numpy as np
+
+import permeability_functions.thermo_core as thermo_core
+
+# Per-window uncertainties of mean forces, and their propagation
+# through the free energy, resistance, and permeability
+# Like thermo_core, everything works on plain floats in the canonical units
+#   length : angstrom
+#   time : picosecond
+#   energy : kilocalorie/mole
+#   force : kilocalorie/(mole*angstrom)
+# Windows are independent simulations, so their errors are uncorrelated,
+# but the free energy of a window depends on every earlier mean force
+
+def block_average(data, min_blocks=2):
+    """ Flyvbjerg-Petersen blocking of a correlated timeseries
+
+    Params
+    ------
+    data : np.ndarray, shape=(n,)
+    min_blocks : int, default=2
+        Levels with fewer blocks are left out
+
+    Returns
+    -------
+    block_sizes : np.ndarray, shape=(n_levels,)
+        Frames per block at each level, 1, 2, 4, ...
+    sems : np.ndarray, shape=(n_levels,)
+        Standard error of the mean estimated from the block means
+    sem_errors : np.ndarray, shape=(n_levels,)
+        Uncertainty of each sem
+
+    Notes
+    -----
+    Each level averages neighboring pairs of the previous one, dropping
+    a trailing unpaired value, so all levels together cost O(n).
+    For correlated data, sems grow with block size until blocks are
+    longer than the correlation time, then plateau; see `optimal_sem`
+    """
+    averager = BlockAverager()
+    averager.update(data)
+    return averager.result(min_blocks=min_blocks)
+
+class BlockAverager(object):
+    """ Online Flyvbjerg-Petersen blocking over chunks of a timeseries
+
+    Notes
+    -----
+    Feed consecutive chunks with `update`, then call `result`, which gives
+    the same levels as `block_average` on the whole timeseries.
+    Each level keeps the count, sum, and sum of squares of the values
+    that entered it, and at most one value waiting for its pair, so memory
+    is O(log n) and each frame is touched O(1) times on average.
+    Values are shifted by the first frame to avoid cancellation in the sums
+    """
+    def __init__(self):
+        self.n_frames = 0
+        self._shift = None
+        self._counts = []
+        self._sums = []
+        self._sums_squared = []
+        self._pending = []
+
+    def update(self, data):
+        """ Add the next chunk of the timeseries """
+        values = np.asarray(data, dtype=float).reshape(-1)
+        if values.size == 0:
+            return
+        if self._shift is None:
+            self._shift = values[0]
+        self.n_frames += values.shape[0]
+        values = values - self._shift
+
+        level = 0
+        while values.size > 0:
+            if level == len(self._counts):
+                self._counts.append(0)
+                self._sums.append(0.0)
+                self._sums_squared.append(0.0)
+                self._pending.append(None)
+            self._counts[level] += values.shape[0]
+            self._sums[level] += np.sum(values)
+            self._sums_squared[level] += np.sum(values**2)
+
+            if self._pending[level] is not None:
+                values = np.concatenate(([self._pending[level]], values))
+            n_pairs = values.shape[0] // 2
+            self._pending[level] = (values[-1] if values.shape[0] % 2
+                                    else None)
+            values = 0.5 * (values[0:2*n_pairs:2] + values[1:2*n_pairs:2])
+            level += 1
+
+    def result(self, min_blocks=2):
+        """ Blocking levels of everything seen so far, as in `block_average` """
+        counts = np.array(self._counts, dtype=float)
+        keep = counts >= max(min_blocks, 2)
+        counts = counts[keep]
+        sums = np.array(self._sums)[keep]
+        sums_squared = np.array(self._sums_squared)[keep]
+
+        variances = np.maximum(sums_squared/counts - (sums/counts)**2, 0.0)
+        sems = np.sqrt(variances / (counts - 1))
+        sem_errors = sems / np.sqrt(2 * (counts - 1))
+        block_sizes = 2**np.flatnonzero(keep)
+        return block_sizes, sems, sem_errors
+
+    def sem(self, min_blocks=16):
+        """ Plateau estimate of the standard error of the mean, see `optimal_sem` """
+        return optimal_sem(*self.result(min_blocks=2), n_frames=self.n_frames,
+                            min_blocks=min_blocks)
+
+def optimal_sem(block_sizes, sems, sem_errors, n_frames, min_blocks=16):
+    """ Standard error of the mean at the plateau of a blocking analysis
+
+    Params
+    ------
+    block_sizes, sems, sem_errors : np.ndarray
+        As returned by `block_average`
+    n_frames : int
+        Length of the timeseries
+    min_blocks : int, default=16
+        Levels with fewer blocks are too noisy to define the plateau
+
+    Returns
+    -------
+    sem : float
+        sem of the first level that agrees with the next one within their
+        uncertainties. If no level does, the blocks never got longer than
+        the correlation time; the largest sem is returned, which is
+        still an underestimate
+    converged : bool
+        Whether a plateau was found
+    """
+    usable = n_frames // block_sizes >= min_blocks
+    sems = sems[usable]
+    sem_errors = sem_errors[usable]
+    if sems.shape[0] == 0:
+        return np.nan, False
+    plateau = np.abs(sems[1:] - sems[:-1]) <= np.hypot(sem_errors[1:],
+                                                        sem_errors[:-1])
+    if np.any(plateau):
+        return sems[np.argmax(plateau)], True
+    return np.max(sems), False
+
+def statistical_inefficiency(facf, n_frames=None):
+    """ Statistical inefficiency from a force autocorrelation function
+
+    Params
+    ------
+    facf : np.ndarray, shape=(..., funlen)
+        Autocorrelation at lags of 0, 1, 2, ... frames, e.g. from
+        thermo_core.acf or batch_acf
+    n_frames : int or np.ndarray, optional
+        Length of each timeseries, for the (1 - t/n) finite-size weights
+
+    Returns
+    -------
+    g : float or np.ndarray, shape=(...)
+        g = 1 + 2 * sum_t (1 - t/n) C(t)/C(0), summed over lags before
+        the first zero crossing of C, and at least 1. The timeseries
+        holds n/g effectively independent samples
+    """
+    facf = np.asarray(facf, dtype=float)
+    normalized = facf / facf[..., :1]
+    lags = np.arange(facf.shape[-1])
+    # Lags up to (not including) the first nonpositive value
+    before_crossing = np.cumprod(normalized > 0, axis=-1).astype(bool)
+    weights = np.ones(facf.shape[-1])
+    if n_frames is not None:
+        n_frames = np.asarray(n_frames, dtype=float)[..., np.newaxis]
+        weights = 1.0 - lags / n_frames
+    terms = np.where(before_crossing, weights * normalized, 0.0)[..., 1:]
+    g = 1.0 + 2.0 * np.sum(terms, axis=-1)
+    return np.maximum(g, 1.0)
+
+def effective_sample_size(n_frames, g):
+    """ Number of effectively independent samples, n/g """
+    return np.asarray(n_frames) / g
+
+def mean_force_sem(facf, n_frames):
+    """ Standard error of mean forces from their autocorrelation functions
+
+    Params
+    ------
+    facf : np.ndarray, shape=(..., funlen)
+        FACF in force**2, C(0) is the variance of the forces
+    n_frames : int or np.ndarray
+
+    Returns
+    -------
+    sem : float or np.ndarray, shape=(...)
+        sqrt(C(0) * g / n), in the units of the forces
+    """
+    facf = np.asarray(facf, dtype=float)
+    g = statistical_inefficiency(facf, n_frames=n_frames)
+    return np.sqrt(facf[..., 0] * g / np.asarray(n_frames, dtype=float))
+
+def free_energy_jacobian(reaction_coordinates):
+    """ Derivative of each window's free energy with respect to each mean force
+
+    Returns
+    -------
+    jacobian : np.ndarray, shape=(n, n)
+        thermo_core.compute_free_energy_profile(forces, x) is
+        jacobian @ forces, a negative cumulative trapezoid
+    """
+    half_widths = 0.5 * np.diff(reaction_coordinates)
+    n_windows = half_widths.shape[0] + 1
+    segments = np.zeros((n_windows - 1, n_windows))
+    segments[np.arange(n_windows - 1), np.arange(n_windows - 1)] = half_widths
+    segments[np.arange(n_windows - 1), np.arange(1, n_windows)] = half_widths
+    return -np.vstack((np.zeros((1, n_windows)), np.cumsum(segments, axis=0)))
+
+def propagate_free_energy_error(force_errors, reaction_coordinates):
+    """ Uncertainty of the free energy profile, kcal/mol
+
+    Params
+    ------
+    force_errors : np.ndarray, shape=(n,)
+        Standard errors of the mean forces, kcal/(mol*angstrom)
+    reaction_coordinates : np.ndarray, shape=(n,)
+        Window positions in angstrom
+
+    Returns
+    -------
+    fe_errors : np.ndarray, shape=(n,)
+        Grows along the profile, since each window's free energy
+        integrates every earlier mean force
+    """
+    jacobian = free_energy_jacobian(reaction_coordinates)
+    return np.sqrt(jacobian**2 @ np.asarray(force_errors)**2)
+
+def propagate_permeability_error(reaction_coordinates, mean_forces,
+                                facf_integrals, force_errors,
+                                facf_integral_errors=None,
+                                kbt=thermo_core.KB*thermo_core.TEMP):
+    """ First-order propagation of window errors through thermo_core.permeability_routine
+
+    Params
+    ------
+    reaction_coordinates, mean_forces, facf_integrals : np.ndarray, shape=(n,)
+        As in thermo_core.permeability_routine
+    force_errors : np.ndarray, shape=(n,)
+        Standard errors of the mean forces, e.g. from `mean_force_sem`
+    facf_integral_errors : np.ndarray, shape=(n,), optional
+        Standard errors of the FACF integrals, taken as 0 by default
+    kbt : float
+
+    Returns
+    -------
+    fe_errors : kcal/mol
+    resistance_errors : ps/angstrom**2
+    resistance_integral_error : ps/angstrom
+    permeability_integral_error : angstrom/ps
+
+    Notes
+    -----
+    The resistance integrand is r = exp(G/kT) * I / kT**2, so
+    dr = r * (dG/kT + dI/I). The free energies share earlier mean forces,
+    so the integral's error goes through the full Jacobian with respect
+    to the (independent) mean forces and FACF integrals
+    """
+    force_errors = np.asarray(force_errors, dtype=float)
+    if facf_integral_errors is None:
+        facf_integral_errors = np.zeros_like(force_errors)
+    facf_integral_errors = np.asarray(facf_integral_errors, dtype=float)
+
+    jacobian = free_energy_jacobian(reaction_coordinates)
+    fe_profile = jacobian @ mean_forces
+    diffusion_profile = thermo_core.compute_diffusion_coefficient(facf_integrals,
+                                                                kbt=kbt)
+    resistance_profile, resistance_integral = thermo_core.compute_resistance_profile(
+                        fe_profile, diffusion_profile, reaction_coordinates,
+                        kbt=kbt)
+
+    fe_errors = np.sqrt(jacobian**2 @ force_errors**2)
+    resistance_errors = resistance_profile * np.sqrt((fe_errors/kbt)**2 +
+                                    (facf_integral_errors/facf_integrals)**2)
+
+    # Trapezoid weight of each window in the resistance integral
+    half_widths = 0.5 * np.diff(reaction_coordinates)
+    weights = np.concatenate((half_widths, [0.0])) + np.concatenate(([0.0], half_widths))
+    force_gradient = (weights * resistance_profile / kbt) @ jacobian
+    facf_gradient = weights * resistance_profile / facf_integrals
+    resistance_integral_error = np.sqrt(np.sum((force_gradient * force_errors)**2) +
+                                np.sum((facf_gradient * facf_integral_errors)**2))
+    permeability_integral_error = resistance_integral_error / resistance_integral**2
+    return (fe_errors, resistance_errors, resistance_integral_error,
+            permeability_integral_error)
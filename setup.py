@@ -30,7 +30,10 @@ setup(name='permeability_functions',
       author='Alexander Yang',
       author_email='alexander.h.yang@vanderbilt.edu',
       license='MIT',
-      packages=['permeability_functions'])
+      packages=['permeability_functions'],
+      # Trajectory/grid analysis (grid_functions, spatial_functions) also
+      # needs grid_analysis and bilayer_analysis_functions, which are not on PyPI
+      extras_require={'grid': ['mdtraj', 'scipy']})
 #      install_requires=requirements,
 #      zip_safe=False,
 #      test_suite='tests',